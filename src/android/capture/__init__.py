@@ -1,4 +1,13 @@
-from .screen import ScreenCapturer
 from .video import VideoCapturer
 from .image import ImageDirCapturer
-from .window import DesktopCapturer
+
+
+def __getattr__(name):
+    # 窗口截图依赖pywin32, 用到时才导入, 这样离线回放等不截窗口的场景在没有pywin32的机器上也能运行
+    if name == "ScreenCapturer":
+        from .screen import ScreenCapturer
+        return ScreenCapturer
+    if name == "DesktopCapturer":
+        from .window import DesktopCapturer
+        return DesktopCapturer
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -6,6 +6,12 @@ class Capturer(ABC):
     def capture(self):
         pass
 
+    def capture_region(self, x1, y1, x2, y2):
+        """
+        截取capture结果中的一块区域, 默认先整张截图再裁剪, 子类可以只截这块区域
+        """
+        return self.capture()[y1: y2, x1: x2]
+
     @abstractmethod
     def init_env(self):
         pass
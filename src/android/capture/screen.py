@@ -47,6 +47,23 @@ class ScreenCapturer(Capturer):
             im_opencv = self.post_address(im_opencv)
         return im_opencv
 
+    def capture_region(self, x1, y1, x2, y2):
+        if self.post_address:  # 后处理可能改变坐标, 只能整张截
+            return super().capture_region(x1, y1, x2, y2)
+        w, h = x2 - x1, y2 - y1
+        region_bitmap = self.region_bitmaps.get((w, h))
+        if region_bitmap is None:  # 每种区域大小开辟一次内存
+            region_bitmap = win32ui.CreateBitmap()
+            region_bitmap.CreateCompatibleBitmap(self.mfcDC, w, h)
+            self.region_bitmaps[(w, h)] = region_bitmap
+        self.neicunDC.SelectObject(region_bitmap)
+        self.neicunDC.BitBlt((0, 0), (w, h), self.mfcDC, (self.x1 + x1, self.y1 + y1), win32con.SRCCOPY)
+        signedIntsArray = region_bitmap.GetBitmapBits(True)
+        self.neicunDC.SelectObject(self.savebitmap)
+        im_opencv = np.frombuffer(signedIntsArray, dtype='uint8')
+        im_opencv.shape = (h, w, 4)
+        return im_opencv[..., :-1]
+
     def init_env(self):
         self.hwndDC = win32gui.GetWindowDC(self.hwnd)
         self.mfcDC = win32ui.CreateDCFromHandle(self.hwndDC)
@@ -54,11 +71,14 @@ class ScreenCapturer(Capturer):
         self.savebitmap = win32ui.CreateBitmap()
         self.savebitmap.CreateCompatibleBitmap(self.mfcDC, self.w, self.h) # 开辟内存
         self.neicunDC.SelectObject(self.savebitmap) # 设定截图存储对象
+        self.region_bitmaps = {}  # (w, h) -> 区域截图用的bitmap
 
     def clear(self):
         self.mfcDC.DeleteDC()
         self.neicunDC.DeleteDC()
         win32gui.DeleteObject(self.savebitmap.GetHandle())
+        for region_bitmap in self.region_bitmaps.values():
+            win32gui.DeleteObject(region_bitmap.GetHandle())
         win32gui.ReleaseDC(self.hwndDC, self.hwndDC)
 
     def reset(self):
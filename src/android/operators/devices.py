@@ -190,11 +190,16 @@ class AdbOperator(OperatorDevice):
         }
 
 
-import pyautogui as pg
-pg.PAUSE = 0.
+def _pyautogui():
+    # pyautogui导入时就需要桌面环境, 创建PyautoguiOperator时才导入, 其他设备(如离线回放的NullOperator)不受影响
+    import pyautogui
+    pyautogui.PAUSE = 0.
+    return pyautogui
+
 
 class PyautoguiOperator(OperatorDevice):
     def __init__(self, x1, y1, x2, y2):
+        self.pg = _pyautogui()
         self.x1 = x1
         self.y1 = y1
         self.x2 = x2
@@ -214,22 +219,22 @@ class PyautoguiOperator(OperatorDevice):
 
     def single(self, xys, fingers=None):
         x, y = self._add_bias(xys[0])
-        pg.leftClick(x, y)
+        self.pg.leftClick(x, y)
 
     def down(self, xys, fingers=None):
         x, y = self._add_bias(xys[0])
-        pg.mouseDown(x, y)
+        self.pg.mouseDown(x, y)
 
     def up(self, fingers=None):
-        pg.mouseUp()
+        self.pg.mouseUp()
 
     def move(self, xys, fingers=None):
         x, y = self._add_bias(xys[0])
-        pg.moveTo(x, y)
+        self.pg.moveTo(x, y)
 
     def tap(self, xy):
         x, y = self._add_bias(xy)
-        pg.leftClick(x, y, duration=0.1)
+        self.pg.leftClick(x, y, duration=0.1)
 
     def stop(self):
         pass
@@ -0,0 +1,252 @@
+"""模式打包
+把模式json、解码后的模板图片、以及由模板派生的数据(二值模板、金字塔、MASK_CMP的mask等)打包成一个文件,
+启动时np.memmap映射进来, 不再逐个解析json、imread、重新计算。
+
+文件布局:
+    MAGIC(8字节) | 头部长度(uint64, 小端) | 头部json(utf8) | 按ALIGNMENT对齐的数组数据
+头部json:
+    modes:   模式文件路径 -> {"mtime": 修改时间, "config": 模式配置}
+    sources: 图片路径 -> 修改时间, 源文件比打包时新的条目加载时会被忽略
+    arrays:  key -> {"offset": 相对数据区的偏移, "shape": 形状, "dtype": 类型}
+    lists:   key -> 列表长度, 列表的第i项存放在 key#i
+"""
+import hashlib
+import json
+import os
+import struct
+from typing import Dict, Hashable, List, Union
+
+import cv2
+import numpy as np
+
+from src.utils.singleton import Singleton
+
+MAGIC = b"TPLBNDL1"
+ALIGNMENT = 64
+
+
+def _normpath(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _array_key(path, kind):
+    return f"{_normpath(path)}|{kind}"
+
+
+@Singleton
+class TemplateImageStore:
+    """
+    模板图片与派生数据的统一入口。加载了bundle时直接给出映射的数组, 否则读磁盘/现算;
+    recording时记录下所有给出的结果, 供compile_bundle写入
+    """
+
+    def __init__(self):
+        self.arrays: Dict[str, np.ndarray] = {}
+        self.lists: Dict[str, int] = {}
+        self.mode_configs: Dict[str, dict] = {}
+        self.bundle_path = None
+        self.recording = False
+        self._recorded_arrays: Dict[str, np.ndarray] = {}
+        self._recorded_lists: Dict[str, int] = {}
+        self._recorded_sources: Dict[str, float] = {}
+        self._recorded_modes: Dict[str, dict] = {}
+
+    def _record_source(self, path):
+        if self.recording:
+            self._recorded_sources[_normpath(path)] = _mtime(path)
+
+    def imread(self, path, flags=cv2.IMREAD_COLOR):
+        key = _array_key(path, f"imread_{flags}")
+        image = self.arrays.get(key)
+        if image is None:
+            image = cv2.imread(path, flags)
+        if self.recording and image is not None:
+            self._record_source(path)
+            self._recorded_arrays[key] = image
+        return image
+
+    def has_image(self, path, flags=cv2.IMREAD_COLOR):
+        """
+        图片可以读到: bundle中有, 或者文件存在
+        """
+        return _array_key(path, f"imread_{flags}") in self.arrays or os.path.exists(path)
+
+    def content_hash(self, path, flags=cv2.IMREAD_COLOR):
+        """
+        图片内容的md5, 不解码也不常驻内存: bundle中有时对映射的数组计算, 否则对文件字节计算, 读不到时返回路径本身
+        """
+        image = self.arrays.get(_array_key(path, f"imread_{flags}"))
+        if image is not None:
+            return hashlib.md5(image.data).hexdigest()
+        try:
+            with open(path, "rb") as f:
+                return hashlib.md5(f.read()).hexdigest()
+        except OSError:
+            return path
+
+    def derived(self, path, kind: Hashable, compute):
+        """
+        由path对应的图片派生出的数组
+        :param kind: 派生方式, 需要包含影响结果的全部参数
+        :param compute: 无参函数, bundle里没有时调用
+        """
+        key = _array_key(path, kind)
+        value = self.arrays.get(key)
+        if value is None:
+            value = compute()
+        if self.recording and value is not None:
+            self._record_source(path)
+            self._recorded_arrays[key] = value
+        return value
+
+    def derived_list(self, path, kind: Hashable, compute) -> List[np.ndarray]:
+        """
+        derived的列表版本(如金字塔)
+        """
+        key = _array_key(path, kind)
+        count = self.lists.get(key)
+        if count is not None:
+            values = [self.arrays.get(f"{key}#{i}") for i in range(count)]
+            if all(value is not None for value in values):
+                return values
+        values = compute()
+        if self.recording:
+            self._record_source(path)
+            self._recorded_lists[key] = len(values)
+            for i, value in enumerate(values):
+                self._recorded_arrays[f"{key}#{i}"] = value
+        return values
+
+    def mode_config(self, mode_config_file) -> dict:
+        mode_config = self.mode_configs.get(_normpath(mode_config_file))
+        if mode_config is None:
+            with open(mode_config_file, "r", encoding="utf8") as f:
+                mode_config = json.load(f)
+        if self.recording:
+            self._recorded_modes[_normpath(mode_config_file)] = {"mtime": _mtime(mode_config_file),
+                                                                 "config": mode_config}
+        return mode_config
+
+    def start_recording(self):
+        self.recording = True
+        self._recorded_arrays, self._recorded_lists = {}, {}
+        self._recorded_sources, self._recorded_modes = {}, {}
+
+    def stop_recording(self):
+        self.recording = False
+        return self._recorded_modes, self._recorded_sources, self._recorded_arrays, self._recorded_lists
+
+    def load(self, bundle_path):
+        """
+        映射bundle, 数组都是只读的memmap视图, 不发生拷贝
+        """
+        mm = np.memmap(bundle_path, dtype=np.uint8, mode="r")
+        if bytes(mm[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{bundle_path} 不是模式bundle文件")
+        header_len, = struct.unpack("<Q", bytes(mm[len(MAGIC): len(MAGIC) + 8]))
+        header_start = len(MAGIC) + 8
+        header = json.loads(bytes(mm[header_start: header_start + header_len]).decode("utf8"))
+        data_start = _align(header_start + header_len)
+
+        # 源文件在打包后改过的, 对应的条目全部丢弃
+        stale_paths = {path for path, mtime in header["sources"].items()
+                       if mtime is not None and (_mtime(path) or 0) > mtime}
+        for mode_path, mode in header["modes"].items():
+            if mode["mtime"] is not None and (_mtime(mode_path) or 0) > mode["mtime"]:
+                continue
+            self.mode_configs[mode_path] = mode["config"]
+        for key, info in header["arrays"].items():
+            if key.rsplit("|", 1)[0] in stale_paths:
+                continue
+            self.arrays[key] = np.ndarray(tuple(info["shape"]), dtype=np.dtype(info["dtype"]), buffer=mm,
+                                          offset=data_start + info["offset"])
+        for key, count in header["lists"].items():
+            if key.rsplit("|", 1)[0] not in stale_paths:
+                self.lists[key] = count
+        self.bundle_path = bundle_path
+        return len(self.arrays)
+
+    def clear(self):
+        self.arrays, self.lists, self.mode_configs = {}, {}, {}
+        self.bundle_path = None
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_bundle(bundle_path, modes: dict, sources: dict, arrays: Dict[str, np.ndarray], lists: Dict[str, int]):
+    array_infos = {}
+    offset = 0
+    for key, array in arrays.items():
+        array_infos[key] = {"offset": offset, "shape": list(array.shape), "dtype": array.dtype.str}
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({"modes": modes, "sources": sources, "arrays": array_infos, "lists": lists},
+                        ensure_ascii=False).encode("utf8")
+    header_start = len(MAGIC) + 8
+    data_start = _align(header_start + len(header))
+    with open(bundle_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.write(b"\0" * (data_start - header_start - len(header)))
+        for key, array in arrays.items():
+            f.seek(data_start + array_infos[key]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+
+
+def compile_bundle(mode_config_files: List[str], bundle_path):
+    """
+    按正常流程加载一遍模式, 把用到的配置、图片和派生数据写进bundle
+    :return: 写入的数组个数
+    """
+    from .template import TemplateMode  # template 依赖本模块, 这里延迟导入
+
+    store = TemplateImageStore()
+    store.start_recording()
+    try:
+        for mode_config_file in mode_config_files:
+            TemplateMode(mode_config_file).load_images()  # 图片是按需加载的, 这里全部读一遍才会被记录
+    finally:
+        modes, sources, arrays, lists = store.stop_recording()
+    if not arrays:
+        raise RuntimeError(f"没有记录到任何数组, 不写入 {bundle_path}: 检查模式中的图片路径, "
+                           f"或者是否记录在了另一个TemplateImageStore实例上")
+    write_bundle(bundle_path, modes, sources, arrays, lists)
+    return len(arrays)
+
+
+def load_bundle(bundle_path) -> Union[int, None]:
+    """
+    :return: 映射进来的数组个数, 文件不存在时返回None
+    """
+    if not os.path.exists(bundle_path):
+        return None
+    return TemplateImageStore().load(bundle_path)
+
+
+if __name__ == "__main__":
+    # 用法: python -m src.templates.bundle cfg.yaml modes.bundle
+    import sys
+    import time
+
+    import yaml
+
+    # 以 -m 运行时本文件是__main__, 其中的TemplateImageStore与模式、检测器用到的不是同一个单例, 要从包里导入
+    from src.templates.bundle import compile_bundle
+
+    cfg_path = sys.argv[1] if len(sys.argv) > 1 else "./cfg.yaml"
+    with open(cfg_path, "r", encoding="utf8") as f:
+        cfg = yaml.safe_load(f)
+    out_path = sys.argv[2] if len(sys.argv) > 2 else cfg.get("bundle") or "./modes.bundle"
+    start = time.perf_counter()
+    num_arrays = compile_bundle(cfg.get("modes"), out_path)
+    print(f"打包 {len(cfg.get('modes'))} 个模式, {num_arrays} 个数组 -> {out_path}, "
+          f"耗时 {time.perf_counter() - start:.3f}s")
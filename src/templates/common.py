@@ -1,18 +1,237 @@
 # 统一管理state的存放于消费的类
-from typing import Union
+import threading
+import time
+import zlib
+from collections import defaultdict
+from typing import Union, Iterable, Hashable, List, Dict, Tuple
 
+import numpy as np
 
-class StatePool:
-    def __init__(self):
-        self.state_pool = set()
+from src.utils.singleton import Singleton
+from src.utils.time import StageTimeRecorder, Stage
+
+
+class StatePool(set):
+    """
+    状态集合。额外维护 state -> 以它为前件的模板 的倒排索引，以及每个模板还缺几个前件，
+    集合增删时只更新受影响的模板，缺0个前件的模板就是当前可以匹配的模板，不需要每轮逐个issuperset。
+    模板通过register_templates按组(比如一个模式)注册，eligible_templates按注册顺序给出组内可匹配的模板
+    """
+
+    def __init__(self, states: Iterable = ()):
+        super().__init__()
+        self._precondition_index = defaultdict(list)  # state -> [template, ...]
+        self._missing_count = {}  # template -> 还缺少的前件数
+        self._eligible = set()
+        self._groups: Dict[Hashable, List] = {}
+        self._eligible_cache: Dict[Hashable, List] = {}  # 可匹配集合不变时直接复用
+        self.update(states)
+
+    def register_templates(self, group: Hashable, templates: Iterable):
+        templates = list(templates)
+        for template in templates:
+            if template in self._missing_count:
+                continue
+            precondition = set(template.common_info.precondition or ())
+            for state in precondition:
+                self._precondition_index[state].append(template)
+            self._missing_count[template] = len(precondition - self)
+            if self._missing_count[template] == 0:
+                self._eligible.add(template)
+        self._groups[group] = templates
+        self._eligible_cache.pop(group, None)
+
+    def eligible_templates(self, group: Hashable) -> Union[List, None]:
+        """
+        :return: 组内前件都满足的模板, 按注册顺序; 组没有注册过时返回None
+        """
+        if group not in self._groups:
+            return None
+        eligible_templates = self._eligible_cache.get(group)
+        if eligible_templates is None:
+            eligible_templates = [template for template in self._groups[group] if template in self._eligible]
+            self._eligible_cache[group] = eligible_templates
+        return eligible_templates
+
+    def _on_state_added(self, state):
+        for template in self._precondition_index.get(state, ()):
+            self._missing_count[template] -= 1
+            if self._missing_count[template] == 0:
+                self._eligible.add(template)
+                self._eligible_cache.clear()
+
+    def _on_state_removed(self, state):
+        for template in self._precondition_index.get(state, ()):
+            self._missing_count[template] += 1
+            if self._missing_count[template] == 1:
+                self._eligible.discard(template)
+                self._eligible_cache.clear()
+
+    def add(self, state):
+        if state not in self:
+            super().add(state)
+            self._on_state_added(state)
+
+    def update(self, *states_list):
+        for states in states_list:
+            for state in states:
+                self.add(state)
+
+    def discard(self, state):
+        if state in self:
+            super().discard(state)
+            self._on_state_removed(state)
+
+    def remove(self, state):
+        if state not in self:
+            raise KeyError(state)
+        self.discard(state)
+
+    def pop(self):
+        if not self:
+            raise KeyError("pop from an empty StatePool")
+        state = next(iter(self))
+        self.discard(state)
+        return state
+
+    def difference_update(self, *states_list):
+        for states in states_list:
+            for state in list(states):
+                self.discard(state)
+
+    def intersection_update(self, *states_list):
+        keep = set(self).intersection(*states_list)
+        self.difference_update(set(self) - keep)
+
+    def symmetric_difference_update(self, states):
+        for state in set(states):
+            if state in self:
+                self.discard(state)
+            else:
+                self.add(state)
+
+    def clear(self):
+        self.difference_update(set(self))
+
+    def __ior__(self, states):
+        self.update(states)
+        return self
+
+    def __isub__(self, states):
+        self.difference_update(states)
+        return self
+
+    def __iand__(self, states):
+        self.intersection_update(states)
+        return self
+
+    def __ixor__(self, states):
+        self.symmetric_difference_update(states)
+        return self
+
+    def __repr__(self):
+        return repr(set(self))
 
 
 class Dataset:
     pass
 
 
+class FrameFingerprint:
+    """
+    一帧截图的指纹: 按区域计算crc32校验和, 同一帧里相同的区域只算一次。
+    模板记住上次检测时自己区域的校验和, 没变就可以沿用上次的检测结果
+    """
+
+    def __init__(self, frame):
+        self.frame = frame
+        self._region_keys: Dict[Tuple, Tuple] = {}
+
+    def region_key(self, region) -> Union[Tuple, None]:
+        """
+        :param region: (x, y, w, h), None表示这个区域无法判断是否变化
+        :return: (校验和, 区域形状), region为None时返回None
+        """
+        if region is None:
+            return None
+        region = tuple(region)
+        key = self._region_keys.get(region)
+        if key is None:
+            x, y, w, h = region
+            region_image = np.ascontiguousarray(self.frame[y: y + h, x: x + w, ...])
+            key = (zlib.crc32(region_image), region_image.shape)
+            self._region_keys[region] = key
+        return key
+
+    def frame_key(self, stride=8):
+        """
+        整帧的粗略指纹, 每隔stride个像素采样一次, 用于判断画面是否有变化
+        """
+        sampled = np.ascontiguousarray(self.frame[::stride, ::stride, ...])
+        return zlib.crc32(sampled), sampled.shape
+
+
 # 记录历史的
 
+@Singleton
+class FrameCache:
+    """
+    当前帧的预处理缓存: 多个模板对同一区域做同样的预处理(二值化、金字塔缩小等)时, 每帧只算一次。
+    key由调用方给出, 一般是 (预处理种类, 区域, 参数...); bind新的一帧时清空。
+    传入的不是当前绑定的帧时直接计算, 不缓存
+    """
+
+    def __init__(self):
+        self.frame = None
+        self._values = {}
+        self._pending = {}  # key -> 正在计算它的线程完成时set的Event
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, frame):
+        with self._lock:
+            self.frame = frame
+            self._values = {}
+            self._pending = {}
+
+    def get(self, frame, key: Hashable, compute):
+        """
+        同一个key只会有一个线程在计算, 并行检测时其他线程等它算完直接取结果
+        :param compute: 无参函数, 没有缓存时调用它得到结果
+        """
+        if frame is None or frame is not self.frame:
+            return compute()
+        values, pending = self._values, self._pending
+        while True:
+            with self._lock:
+                if key in values:
+                    self.hits += 1
+                    return values[key]
+                computing = pending.get(key)
+                if computing is None:
+                    computing = pending[key] = threading.Event()
+                    break
+            computing.wait()  # 计算失败时key不在values里, 会由本线程重新计算
+        try:
+            start = time.perf_counter()
+            value = compute()
+            if not (isinstance(key, tuple) and key[0] == "detect"):  # 检测的耗时由模板自己记录
+                StageTimeRecorder().record(Stage.CROP, key[0] if isinstance(key, tuple) else key,
+                                           time.perf_counter() - start, start)
+            with self._lock:
+                self.misses += 1
+                values[key] = value
+            return value
+        finally:
+            with self._lock:
+                pending.pop(key, None)
+            computing.set()
+
+    def __str__(self):
+        return f"帧缓存: 命中{self.hits}, 计算{self.misses}"
+
+
 from collections import deque
 class MatchedTemplateItem:
     def __init__(self, name, count=1):
@@ -18,27 +18,169 @@ class MatchMethod(Enum):
 """One of [TM_SQDIFF, TM_SQDIFF_NORMED, TM_CCORR, TM_CCORR_NORMED, TM_CCOEFF, TM_CCOEFF_NORMED]"""
 
 
-def search_template(template, background, method: Union[str, MatchMethod], theta=0.9) -> Tuple[
-    List[Tuple[Any, Any, Any, Any]], Union[UMat, Mat, ndarray]]:
-    if isinstance(method, str):
-        method = MatchMethod[method]
-    h, w = template.shape[:2]
-    res = cv2.matchTemplate(background, template, method.value)
+SUPPRESS_DIST = 10  # 曼哈顿距离小于它的候选点视为同一个目标
+
+
+def _candidates_mask(res, method: MatchMethod, theta):
     if method == MatchMethod.TM_SQDIFF_NORMED:
-        candidates = np.where(res < (1 - theta))
+        return res < (1 - theta)
     elif method == MatchMethod.TM_CCOEFF_NORMED:
-        candidates = np.where(res >= theta)
-    final_xy_points = []
-    # print(np.max(res))
+        return res >= theta
+
 
+def _suppress_candidates_by_loop(candidates_mask, min_dist=SUPPRESS_DIST):
+    # 原来的两两比较写法，候选点多的时候是平方复杂度，只留给benchmark对照
+    candidates = np.where(candidates_mask)
+    final_xy_points = []
     INF_DIST = 9999
     for x1, y1 in zip(candidates[1], candidates[0]):
-        min_dist = INF_DIST
+        min_dist_ = INF_DIST
         for x2, y2 in final_xy_points:
             dist = abs(x1 - x2) + abs(y1 - y2)
-            min_dist = min(min_dist, dist)
-        if min_dist >= 10:
+            min_dist_ = min(min_dist_, dist)
+        if min_dist_ >= min_dist:
             final_xy_points.append((x1, y1))
+    return final_xy_points
+
+
+def suppress_candidates(candidates_mask, min_dist=SUPPRESS_DIST, max_count=None, scores=None):
+    """
+    按行优先顺序贪心去重: 每接受一个点，就把它之后曼哈顿距离小于min_dist的候选点从mask里抹掉，
+    再用argmax找下一个剩余的候选点。结果与两两比较的写法完全一致，但开销只和接受的点数有关
+    :param candidates_mask: matchTemplate结果上超过阈值的bool矩阵
+    :param max_count: 最多保留多少个点, None表示不限制
+    :param scores: 与mask同形状的得分(越大越相似), 给出且限制了max_count时按得分从高到低贪心去重, 保留最好的max_count个
+    :return: [(x, y), ...]
+    """
+    if max_count is not None and scores is not None:
+        return _suppress_candidates_by_score(candidates_mask, scores, min_dist, max_count)
+    mask = np.array(candidates_mask, dtype=bool, copy=True)
+    h, w = mask.shape
+    flat = mask.reshape(-1)
+    final_xy_points = []
+    pos = 0
+    while max_count is None or len(final_xy_points) < max_count:
+        if pos >= flat.size:
+            break
+        pos += int(np.argmax(flat[pos:]))
+        if not flat[pos]:
+            break
+        y, x = divmod(pos, w)
+        final_xy_points.append((x, y))
+        # 上方的行已经处理过了，只需要抹掉当前行及下面 min_dist-1 行的菱形区域
+        for dy in range(min(min_dist, h - y)):
+            r = min_dist - 1 - dy
+            mask[y + dy, max(0, x - r): x + r + 1] = False
+    return final_xy_points
+
+
+def _suppress_candidates_by_score(candidates_mask, scores, min_dist, max_count):
+    # 候选点按得分从高到低(同分时按行优先)处理, 每接受一个点, 抹掉它上下左右曼哈顿距离小于min_dist的候选点
+    mask = np.array(candidates_mask, dtype=bool, copy=True)
+    h, w = mask.shape
+    ys, xs = np.nonzero(mask)
+    order = np.argsort(-scores[ys, xs], kind="stable")
+    final_xy_points = []
+    for idx in order:
+        if len(final_xy_points) >= max_count:
+            break
+        y, x = int(ys[idx]), int(xs[idx])
+        if not mask[y, x]:
+            continue
+        final_xy_points.append((x, y))
+        for dy in range(-min(min_dist - 1, y), min(min_dist, h - y)):
+            r = min_dist - 1 - abs(dy)
+            mask[y + dy, max(0, x - r): x + r + 1] = False
+    return final_xy_points
+
+
+def search_template(template, background, method: Union[str, MatchMethod], theta=0.9, max_count=None) -> Tuple[
+    List[Tuple[Any, Any, Any, Any]], Union[UMat, Mat, ndarray]]:
+    if isinstance(method, str):
+        method = MatchMethod[method]
+    h, w = template.shape[:2]
+    res = cv2.matchTemplate(background, template, method.value)
+    scores = None if max_count is None else _match_score(res, method)  # 限制个数时按得分保留最好的
+    final_xy_points = suppress_candidates(_candidates_mask(res, method, theta), max_count=max_count, scores=scores)
+    final_xyxy_boxes = [(x, y, x + w, y + h) for x, y in final_xy_points]
+    return final_xyxy_boxes, res
+
+
+PYRAMID_MIN_SIZE = 8  # 金字塔顶层模板的最小边长, 太小的模板粗匹配没有意义
+
+
+def build_pyramid(img, levels):
+    """
+    :return: [原图, 1/2, 1/4, ...], 长度为实际可用的层数+1, 模板太小时会自动减少层数
+    """
+    pyramid = [img]
+    for _ in range(levels):
+        h, w = pyramid[-1].shape[:2]
+        if min(h, w) // 2 < PYRAMID_MIN_SIZE:
+            break
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
+
+def pyr_down(img, levels):
+    for _ in range(levels):
+        img = cv2.pyrDown(img)
+    return img
+
+
+def _match_score(res, method: MatchMethod):
+    # 统一成越大越相似
+    if method == MatchMethod.TM_SQDIFF_NORMED:
+        return 1 - res
+    return res
+
+
+def search_template_pyramid(template_pyramid, background, method: Union[str, MatchMethod], theta=0.9,
+                            max_count=None, coarse_candidates=10, coarse_margin=0.15, small_background=None) -> Tuple[
+    List[Tuple[Any, Any, Any, Any]], Union[UMat, Mat, ndarray]]:
+    """
+    由粗到细的search_template: 先在金字塔顶层用缩小的模板匹配缩小的背景，取局部极大值中得分最高的几个，
+    再回到原分辨率只在这些候选点附近的小窗口里matchTemplate。返回值和search_template一致，
+    res中没有被计算的位置填充为"不匹配"
+    :param template_pyramid: build_pyramid预先算好的模板金字塔
+    :param coarse_candidates: 粗匹配最多保留多少个候选点进行精匹配
+    :param coarse_margin: 缩小后相似度会下降, 粗匹配阈值为 theta - coarse_margin
+    :param small_background: 预先缩小到顶层的背景(如帧缓存中的), None时在这里pyrDown
+    """
+    if isinstance(method, str):
+        method = MatchMethod[method]
+    template = template_pyramid[0]
+    h, w = template.shape[:2]
+    bg_h, bg_w = background.shape[:2]
+    levels = len(template_pyramid) - 1
+    if levels == 0 or bg_h >> levels < template_pyramid[-1].shape[0] or bg_w >> levels < template_pyramid[-1].shape[1]:
+        return search_template(template, background, method, theta, max_count)
+
+    if small_background is None:
+        small_background = pyr_down(background, levels)
+    coarse_score = _match_score(cv2.matchTemplate(small_background, template_pyramid[-1], method.value), method)
+    # 3x3邻域内的局部极大值, 再按得分取前coarse_candidates个
+    peaks = (coarse_score >= cv2.dilate(coarse_score, np.ones((3, 3), np.uint8))) & \
+            (coarse_score >= theta - coarse_margin)
+    peak_ys, peak_xs = np.nonzero(peaks)
+    order = np.argsort(-coarse_score[peak_ys, peak_xs], kind="stable")[:coarse_candidates]
+
+    fill_value = 1. if method == MatchMethod.TM_SQDIFF_NORMED else -1.
+    res = np.full((bg_h - h + 1, bg_w - w + 1), fill_value, dtype=np.float32)
+    scale = 1 << levels
+    radius = scale + 2  # pyrDown的取整误差
+    for idx in order:
+        x0 = max(0, int(peak_xs[idx]) * scale - radius)
+        y0 = max(0, int(peak_ys[idx]) * scale - radius)
+        x1 = min(res.shape[1], int(peak_xs[idx]) * scale + radius + 1)
+        y1 = min(res.shape[0], int(peak_ys[idx]) * scale + radius + 1)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        window = background[y0: y1 + h - 1, x0: x1 + w - 1]
+        res[y0: y1, x0: x1] = cv2.matchTemplate(window, template, method.value)
+
+    scores = None if max_count is None else _match_score(res, method)  # 限制个数时按得分保留最好的
+    final_xy_points = suppress_candidates(_candidates_mask(res, method, theta), max_count=max_count, scores=scores)
     final_xyxy_boxes = [(x, y, x + w, y + h) for x, y in final_xy_points]
     return final_xyxy_boxes, res
 
@@ -55,86 +197,100 @@ def compare_similarity_with_template(target, template, method: Union[str, MatchM
         similarity_result = 1 - cv2.matchTemplate(target, template, method=method.value)
         similarity_result = similarity_result.item()
     elif method == MatchMethod.MASK_CMP:
-        saved_img = StoredImage(template)
+        # template可以直接传入预先构建好的StoredImage, 避免每帧重建mask
+        saved_img = template if isinstance(template, StoredImage) else StoredImage(template)
         similarity_result = saved_img.soft_imcmp(target)
     # print(similarity_result)
     return similarity_result
 
 
 class StoredImage:
-    def __init__(self, img, r=1):
+    def __init__(self, img, r=1, mask=None, contour=None):
+        """
+        :param mask: 预先算好的有效像素mask(如bundle中的), None时现算
+        :param contour: 预先算好的边缘图, None时现算
+        """
         if isinstance(img, str):
-            self.img = cv2.imread(img) * 1.0
-        else:
-            self.img = img * 1.0
+            img = cv2.imread(img)
+        self.img = np.asarray(img, dtype=np.uint8)
         self.h, self.w = self.img.shape[:2]
         self.stack_region = r
 
-        self.slice = self.init_shift_stack()
-        self.mask = self.filter_no_use_pixel(self.slice)
+        # 边缘复制后的模板，每个位移都只是它上面的一个切片，不再物化 (2r+1)^2 份位移副本
+        self.padded = cv2.copyMakeBorder(self.img, r, r, r, r, cv2.BORDER_REPLICATE)
+        self.mask = self.filter_no_use_pixel() if mask is None else mask
 
-        self.contour = self.init_contour()
+        self.contour = self.init_contour() if contour is None else contour
         self.contour_mask = np.where(self.contour > 0, 1., 0.)
 
         print("有效像素点：", np.sum(self.mask), "/", self.h * self.w)
         self.num_valid_pixels = np.sum(self.mask)
 
-    def init_shift_stack(self):
-        img, r = self.img, self.stack_region
-        imgs = []
+    def iter_shifts(self):
+        r = self.stack_region
         for i in range(-r, r + 1):
             for j in range(-r, r + 1):
-                # 向右偏移i次，向下偏移i次
-                shifted_img = np.roll(np.roll(img, i, axis=1), j, axis=0)
-                if i > 0:
-                    shifted_img[:i, :] = shifted_img[i:i + 1, :]
-                if j > 0:
-                    shifted_img[:, :j] = shifted_img[:, j:j + 1]
-                if i < 0:
-                    shifted_img[i:, :] = shifted_img[i - 1:i, :]
-                if j < 0:
-                    shifted_img[:, j:] = shifted_img[:, j - 1:j]
-                imgs.append(shifted_img)
-        imgs = np.stack(imgs, axis=0)
-        return imgs * 1.0
-
-    def filter_no_use_pixel(self, region_slide):
+                # 向右偏移i次，向下偏移j次
+                yield self.padded[r - j: r - j + self.h, r - i: r - i + self.w]
+
+    def filter_no_use_pixel(self):
+        # 邻域内的标准差 = sqrt(E[x^2] - E[x]^2)，用boxFilter直接算，等价于对位移栈求方差
+        img = self.img * 1.0
+        ksize = (2 * self.stack_region + 1, 2 * self.stack_region + 1)
+        mean = cv2.boxFilter(img, -1, ksize, borderType=cv2.BORDER_REPLICATE)
+        sq_mean = cv2.boxFilter(img * img, -1, ksize, borderType=cv2.BORDER_REPLICATE)
         mask = np.sum(
-            np.sqrt(np.var(region_slide, axis=0)),
+            np.sqrt(np.maximum(sq_mean - mean * mean, 0.)),
             axis=-1
         )
         threshold = np.mean(mask) / 4
-        mask = np.where(mask >= threshold, 1., 0.)
+        mask = np.where(mask >= threshold, 1., 0.).astype(np.float32)
         return mask
 
     def same_shape(self, img2):
         img2 = cv2.resize(img2, dsize=(self.w, self.h))
         return img2
 
-    # def _calc_distance_var(self, pixel_diff):
-    #     # 判断位移是否集中
-    #     min_index = np.argmin(pixel_diff, axis=0)
-    #     min_list = []
-    #     for i in range(9):
-    #         min_list.append(np.sum((np.where(min_index == i, 1., 0.)) * self.mask))
-    #     distribute = np.array(min_list)
-    #     distribute = distribute / np.sum(distribute)
-    #     print(distribute)
-    #     print(np.var(distribute))
-
     def init_contour(self):
-        image = np.array(self.img, dtype="uint8")
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        gray_image = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY)
         edges = cv2.Canny(gray_image, 50, 100)
         return edges
 
     def soft_imcmp(self, img2):
-        # 这是一个允许微小位移的图片mse方法
-        img2 = self.same_shape(img2) * 1.0
-        rgb_diff = np.abs((self.slice - img2) / 255.)  # 由于self img已经是小数了
-        rgb_diff = np.min(rgb_diff, axis=0)
-        pixel_diff = np.mean(rgb_diff, axis=-1)
+        # 这是一个允许微小位移的图片mse方法: 每个像素取所有位移中最小的差值
+        # 逐个位移做uint8的absdiff并原地取min，内存只需要一张图的大小
+        img2 = np.asarray(self.same_shape(img2), dtype=np.uint8)
+        rgb_diff = None
+        for shifted_img in self.iter_shifts():
+            diff = cv2.absdiff(shifted_img, img2)
+            if rgb_diff is None:
+                rgb_diff = diff
+            else:
+                np.minimum(rgb_diff, diff, out=rgb_diff)
+        pixel_diff = np.sum(rgb_diff, axis=-1, dtype=np.float32) / (3 * 255.)
         pixel_diff *= self.mask
         image_diff = np.sum(pixel_diff) / self.num_valid_pixels
         similarity = 1 - 2 * image_diff  # -1, 1
-        return similarity
+        return float(similarity)
+
+
+if __name__ == "__main__":
+    # benchmark: 大背景 + 低阈值时两种去重写法的耗时对比
+    import time
+
+    rng = np.random.default_rng(0)
+    for bg_w, bg_h in [(480, 300), (960, 600), (1280, 720)]:
+        background = rng.integers(0, 256, size=(bg_h, bg_w, 3), dtype=np.uint8)
+        background = cv2.GaussianBlur(background, (0, 0), 8)  # 平滑的背景, 低阈值下会有大量候选点
+        template = background[50:90, 50:130].copy()
+        res = cv2.matchTemplate(background, template, MatchMethod.TM_CCOEFF_NORMED.value)
+        candidates_mask = _candidates_mask(res, MatchMethod.TM_CCOEFF_NORMED, 0.3)
+        start = time.perf_counter()
+        loop_points = _suppress_candidates_by_loop(candidates_mask)
+        loop_time = time.perf_counter() - start
+        start = time.perf_counter()
+        mask_points = suppress_candidates(candidates_mask)
+        mask_time = time.perf_counter() - start
+        assert [(int(x), int(y)) for x, y in loop_points] == mask_points
+        print(f"{bg_w}x{bg_h}: 候选点{int(np.sum(candidates_mask))}, 保留{len(mask_points)}, "
+              f"loop {loop_time * 1000:.1f}ms, mask {mask_time * 1000:.1f}ms")
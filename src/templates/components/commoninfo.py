@@ -34,5 +34,6 @@ class TemplateCommonInfo:
         self.precondition = None
         self.outcome = None
         self.consume = None
+        self.always_run = False  # 短路匹配时, 即使已有更高优先级的模板匹配成功也照常检测(比如detector要往dataset写数据)
         for key, value in params.items():
             setattr(self, key, value)
@@ -14,8 +14,10 @@
 4.
 识别种类 Differ
 识别结果 self.image 是否与上次不一样"""
+import hashlib
+import os
 from abc import ABC, abstractmethod
-from typing import Tuple, Any, Union
+from typing import Tuple, Any, Union, List
 
 import cv2
 import numpy as np
@@ -23,7 +25,11 @@ import numpy as np
 from src.templates.gui.applications import TemplateMatchConfigUI
 from src.templates.gui.base import ConfigUI
 from src.templates.gui.utils import ScreenShotCropper
-from src.templates.compare import compare_similarity_with_template, search_template, MatchMethod
+from src.templates.compare import compare_similarity_with_template, search_template, MatchMethod, StoredImage, \
+    build_pyramid, search_template_pyramid, pyr_down
+from src.templates.common import FrameCache
+from src.templates.bundle import TemplateImageStore
+from src.templates.imagecache import TemplateImageCache
 from src.utils.binary import mean_binary_img, binary_bg_and_words_colors
 
 
@@ -41,19 +47,116 @@ class TemplateDetector(ABC):
     def detect(self, full_screen_shot, show_detail) -> Tuple[bool, Union[None, dict]]:
         pass
 
+    def detect_region(self) -> Union[None, Tuple]:
+        """
+        检测结果只取决于截图的哪个区域(x, y, w, h); 这个区域没变时可以沿用上次结果, None表示不能沿用
+        """
+        return None
+
+    def is_stateful(self) -> bool:
+        """
+        检测结果依赖之前的帧(上一帧的画面、跟踪窗口等), 这样的检测器不能在模板之间共用
+        """
+        return getattr(self, "tracker", None) is not None
+
+    # 模板图片按需加载: 子类在__init__里设置 self._image_loaders = {种类: 无参加载函数},
+    # 用self._image(种类)取图, 图片放在共享的TemplateImageCache里, 检测器自己不持有
+    def _image(self, kind):
+        return TemplateImageCache().get((self.template_image_path, kind), self._image_loaders[kind])
+
+    def cache_keys(self) -> List[Tuple]:
+        """
+        用到的图片在TemplateImageCache中的key, 所属模式激活时会被pin住
+        """
+        return [(self.template_image_path, kind) for kind in getattr(self, "_image_loaders", {})]
+
+    def load_images(self):
+        """
+        预先把用到的图片读进缓存
+        """
+        for kind in getattr(self, "_image_loaders", {}):
+            self._image(kind)
+
+
+def _load_stored_image(image_path, image, r=1) -> StoredImage:
+    """
+    MASK_CMP用的StoredImage, mask和边缘图可以从bundle中直接取
+    """
+    built = []
+
+    def compute():
+        built.append(StoredImage(image, r))
+        return [built[0].mask, built[0].contour]
+
+    mask, contour = TemplateImageStore().derived_list(image_path, f"stored_image_r{r}", compute)
+    return built[0] if built else StoredImage(image, r, mask=mask, contour=contour)
+
 
 def _print_similarity(template_name, similarity, threshold, detect_succeed):
     print(f"检测: [{template_name}]: [{similarity: .2f}/{threshold: .2f}]. Detect: {detect_succeed}")
 
 
-def _print_max_similarity_and_match_count(template_name, similarity_matrix, threshold, detect_count):
-    print(f"检测: [{template_name}]: [{np.max(similarity_matrix): .2f}/{threshold: .2f}]. Detect Count: {detect_count}")
+def _print_max_similarity_and_match_count(template_name, similarity_matrix, threshold, detect_count, tracker=None):
+    track_info = "" if tracker is None else f" {tracker}"
+    print(f"检测: [{template_name}]: [{np.max(similarity_matrix): .2f}/{threshold: .2f}]. "
+          f"Detect Count: {detect_count}{track_info}")
 
 
 def _print_no_detect(template_name):
     print(f"检测: [{template_name}无需检测]. Detect: True")
 
 
+class LastHitTracker:
+    """
+    存在性检测的目标大多会出现在上次找到的位置: 先在上次命中框外扩margin的小窗口里搜索，
+    没搜到再退回整个背景区域。boxes都是相对背景区域的坐标
+    """
+
+    def __init__(self, margin):
+        self.margin = margin
+        self.last_boxes = []
+        self.hit_count = 0  # 小窗口命中, 省掉了一次全区域搜索
+        self.miss_count = 0  # 小窗口没搜到, 退回了全区域
+        self.full_search_count = 0  # 全区域搜索的总次数(包括没有上次命中时)
+
+    def _roi(self, background):
+        bg_h, bg_w = background.shape[:2]
+        x1 = max(0, min(box[0] for box in self.last_boxes) - self.margin)
+        y1 = max(0, min(box[1] for box in self.last_boxes) - self.margin)
+        x2 = min(bg_w, max(box[2] for box in self.last_boxes) + self.margin)
+        y2 = min(bg_h, max(box[3] for box in self.last_boxes) + self.margin)
+        return x1, y1, x2, y2
+
+    def search(self, search_func, background, full_search_func=None):
+        """
+        :param search_func: search_func(background) -> (xyxy_boxes, similarity_matrix)
+        :param full_search_func: 全区域搜索时调用的无参函数(如使用帧缓存中整个区域的预处理结果), None时为search_func(background)
+        """
+        if self.last_boxes:
+            x1, y1, x2, y2 = self._roi(background)
+            xyxy_boxes, similarity_matrix = search_func(background[y1: y2, x1: x2, ...])
+            if xyxy_boxes:
+                self.hit_count += 1
+                self.last_boxes = [(bx1 + x1, by1 + y1, bx2 + x1, by2 + y1) for bx1, by1, bx2, by2 in xyxy_boxes]
+                return self.last_boxes, similarity_matrix
+            self.miss_count += 1
+        self.full_search_count += 1
+        if full_search_func is None:
+            self.last_boxes, similarity_matrix = search_func(background)
+        else:
+            self.last_boxes, similarity_matrix = full_search_func()
+        return self.last_boxes, similarity_matrix
+
+    @property
+    def hit_rate(self):
+        total = self.hit_count + self.full_search_count
+        return self.hit_count / total if total else 0.
+
+    def __str__(self):
+        return f"[track hit:{self.hit_count}, miss:{self.miss_count}, full:{self.full_search_count}, " \
+               f"rate:{self.hit_rate: .2f}]"
+
+
 class FixedRegionDetector(TemplateDetector):
     @classmethod
     def generate(cls, cropper: ScreenShotCropper):
@@ -87,11 +190,29 @@ class FixedRegionDetector(TemplateDetector):
         self.x1, self.y1, self.w, self.h = self.region
 
         self.template_image_path = kwargs.get("template_image")
-        self.template_image = cv2.imread(self.template_image_path)
+        self._image_loaders = {"image": lambda: TemplateImageStore().imread(self.template_image_path)}
+        # MASK_CMP 的位移栈、mask只和模板有关, 加载时算一次
+        match_method = MatchMethod[self.match_method] if isinstance(self.match_method, str) else self.match_method
+        self._compared_kind = "image"
+        if match_method == MatchMethod.MASK_CMP:
+            self._compared_kind = "stored_image_r1"
+            self._image_loaders[self._compared_kind] = lambda: _load_stored_image(self.template_image_path,
+                                                                                  self.template_image)
+
+    @property
+    def template_image(self):
+        return self._image("image")
+
+    @property
+    def compared_template(self):
+        return self._image(self._compared_kind)
+
+    def detect_region(self) -> Union[None, Tuple]:
+        return self.region
 
     def detect(self, full_screen_shot, show_detail) -> Tuple[bool, Union[None, dict]]:
         region_image = full_screen_shot[self.y1: self.y1 + self.h, self.x1: self.x1 + self.w, ...]
-        similarity = compare_similarity_with_template(region_image, self.template_image, self.match_method)
+        similarity = compare_similarity_with_template(region_image, self.compared_template, self.match_method)
         detect_succeed = similarity >= self.threshold
         if show_detail:
             _print_similarity(self.template_name, similarity, self.threshold, detect_succeed)
@@ -158,16 +279,56 @@ class RegionExistsDetector(TemplateDetector):
         self.dx, self.dy = kwargs.get("dx", 0), kwargs.get("dy", 0)
 
         self.template_image_path = kwargs.get("template_image")
-        self.template_image = cv2.imread(self.template_image_path)
+        # 金字塔层数, 0表示直接在原分辨率上全图搜索
+        self.pyramid_levels = kwargs.get("pyramid_levels", 0)
+        self._image_loaders = {"image": lambda: TemplateImageStore().imread(self.template_image_path)}
+        if self.pyramid_levels:
+            self._image_loaders[f"pyramid_{self.pyramid_levels}"] = lambda: TemplateImageStore().derived_list(
+                self.template_image_path, f"pyramid_{self.pyramid_levels}",
+                lambda: build_pyramid(self.template_image, self.pyramid_levels)[1:])
 
         self.boxes_data_key = kwargs.get("boxes_data_key")
+        self.max_count = kwargs.get("max_count")  # 最多保留多少个检测框, None不限制
         self.xyxy_boxes = None
+        self._frame = None  # 正在检测的帧, 用于查帧缓存
+        # 上次命中位置附近外扩多少像素先搜索, None表示不跟踪
+        track_margin = kwargs.get("track_margin")
+        self.tracker = LastHitTracker(track_margin) if track_margin is not None else None
+
+    @property
+    def template_image(self):
+        return self._image("image")
+
+    @property
+    def template_pyramid(self):
+        if not self.pyramid_levels:
+            return [self.template_image]
+        return [self.template_image] + self._image(f"pyramid_{self.pyramid_levels}")
+
+    def _search(self, background_region_image):
+        if self.pyramid_levels:
+            template_pyramid = self.template_pyramid
+            small_background = None
+            if background_region_image.shape[:2] == (self.h, self.w):  # 整个背景区域(不是跟踪的小窗口), 可以共享
+                levels = len(template_pyramid) - 1
+                small_background = FrameCache().get(self._frame, ("pyramid", tuple(self.background_region), levels),
+                                                    lambda: pyr_down(background_region_image, levels))
+            return search_template_pyramid(template_pyramid, background_region_image,
+                                           self.match_method, self.threshold, self.max_count,
+                                           small_background=small_background)
+        return search_template(self.template_image, background_region_image,
+                               self.match_method, self.threshold, self.max_count)
+
+    def detect_region(self) -> Union[None, Tuple]:
+        return self.background_region
 
     def detect(self, full_screen_shot, show_detail) -> Tuple[bool, Union[None, dict]]:
+        self._frame = full_screen_shot
         background_region_image = full_screen_shot[self.y1: self.y1 + self.h, self.x1: self.x1 + self.w, ...]
-        self.xyxy_boxes, similarity_matrix = search_template(self.template_image, background_region_image,
-                                                             self.match_method,
-                                                             self.threshold)
+        if self.tracker is not None:
+            self.xyxy_boxes, similarity_matrix = self.tracker.search(self._search, background_region_image)
+        else:
+            self.xyxy_boxes, similarity_matrix = self._search(background_region_image)
         ## xyxy_boxes 还要用 x1, y1矫正, 以及dx, dy
         self.xyxy_boxes = [(x1 + self.x1 + self.dx, y1 + self.y1 + self.dy,
                             x2 + self.x1 + self.dx, y2 + self.y1 + self.dy) for x1, y1, x2, y2 in self.xyxy_boxes]
@@ -179,7 +340,7 @@ class RegionExistsDetector(TemplateDetector):
         detect_succeed = len(self.xyxy_boxes) > 0
         if show_detail:
             _print_max_similarity_and_match_count(self.template_name, similarity_matrix, self.threshold,
-                                                  len(self.xyxy_boxes) > 0)
+                                                  len(self.xyxy_boxes) > 0, self.tracker)
         return detect_succeed, boxes_info
 
 
@@ -245,19 +406,84 @@ class BinaryRegionExistsDetector(TemplateDetector):
         self.dx, self.dy = kwargs.get("dx", 0), kwargs.get("dy", 0)
 
         self.template_image_path = kwargs.get("template_image")
-        self.template_image = cv2.imread(self.template_image_path)
-
         self.boxes_data_key = kwargs.get("boxes_data_key")
         self.bg_color = np.array(kwargs.get("bg_color"))
         self.words_color = np.array(kwargs.get("words_color"))
+        self._binary_kind = os.path.basename(self._binary_template_cache_path())
+        self._image_loaders = {"image": lambda: TemplateImageStore().imread(self.template_image_path),
+                               self._binary_kind: self._load_binary_template}
+        self._binary_buffer = None  # 背景二值化的输出缓冲, 每帧复用
+        self.max_count = kwargs.get("max_count")  # 最多保留多少个检测框, None不限制
         self.xyxy_boxes = None
+        # 上次命中位置附近外扩多少像素先搜索, None表示不跟踪
+        track_margin = kwargs.get("track_margin")
+        self.tracker = LastHitTracker(track_margin) if track_margin is not None else None
+
+    @property
+    def template_image(self):
+        return self._image("image")
+
+    @property
+    def binary_template_image(self):
+        return self._image(self._binary_kind)
+
+    def _binary_template_cache_path(self):
+        # 二值化结果依赖颜色, 颜色变了缓存文件名也跟着变
+        colors = np.concatenate([self.bg_color, self.words_color]).astype(np.float64)
+        color_tag = hashlib.md5(colors.tobytes()).hexdigest()[:8]
+        root, _ = os.path.splitext(self.template_image_path)
+        return f"{root}_binary_{color_tag}.png"
+
+    def _load_binary_template(self):
+        """
+        模板不会变, 二值化只在加载时做一次, 并缓存到模板图片旁边; 模板图片比缓存新时重新生成。
+        加载了bundle时直接从bundle中取
+        """
+        return TemplateImageStore().derived(self.template_image_path, self._binary_kind,
+                                            self._load_binary_template_file)
+
+    def _load_binary_template_file(self):
+        cache_path = self._binary_template_cache_path()
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(self.template_image_path):
+            binary_template_image = cv2.imread(cache_path, cv2.IMREAD_GRAYSCALE)
+            if binary_template_image is not None:
+                return binary_template_image
+        binary_template_image = mean_binary_img(self.template_image, self.bg_color, self.words_color)
+        cv2.imwrite(cache_path, binary_template_image)
+        return binary_template_image
+
+    def _binarize(self, background_region_image):
+        binary_background_region_image = mean_binary_img(background_region_image, self.bg_color, self.words_color,
+                                                         out=self._binary_buffer)
+        self._binary_buffer = binary_background_region_image
+        return binary_background_region_image
+
+    def _search(self, binary_background_region_image):
+        return search_template(self.binary_template_image, binary_background_region_image,
+                               self.match_method, self.threshold, self.max_count)
+
+    def detect_region(self) -> Union[None, Tuple]:
+        return self.background_region
 
     def detect(self, full_screen_shot, show_detail) -> Tuple[bool, Union[None, dict]]:
         background_region_image = full_screen_shot[self.y1: self.y1 + self.h, self.x1: self.x1 + self.w, ...]
-        binary_background_region_image = mean_binary_img(background_region_image, self.bg_color, self.words_color)
-        binary_template_image = mean_binary_img(self.template_image, self.bg_color, self.words_color)
-        self.xyxy_boxes, similarity_matrix = search_template(binary_template_image, binary_background_region_image,
-                                                             self.match_method, self.threshold)
+
+        def search_full_region():
+            # 整个背景区域二值化一次(同区域同颜色的模板共享)
+            binary_background_region_image = FrameCache().get(
+                full_screen_shot,
+                ("binary", tuple(self.background_region), tuple(self.bg_color.tolist()),
+                 tuple(self.words_color.tolist())),
+                lambda: self._binarize(background_region_image))
+            return self._search(binary_background_region_image)
+
+        if self.tracker is not None:
+            # 二值化是逐像素的, 跟踪的小窗口只二值化窗口本身, 命中时不必处理整个区域
+            self.xyxy_boxes, similarity_matrix = self.tracker.search(
+                lambda window: self._search(mean_binary_img(window, self.bg_color, self.words_color)),
+                background_region_image, search_full_region)
+        else:
+            self.xyxy_boxes, similarity_matrix = search_full_region()
         ## xyxy_boxes 还要用 x1, y1矫正, 以及dx, dy
         self.xyxy_boxes = [(x1 + self.x1 + self.dx, y1 + self.y1 + self.dy,
                             x2 + self.x1 + self.dx, y2 + self.y1 + self.dy) for x1, y1, x2, y2 in self.xyxy_boxes]
@@ -269,7 +495,7 @@ class BinaryRegionExistsDetector(TemplateDetector):
         detect_succeed = len(self.xyxy_boxes) > 0
         if show_detail:
             _print_max_similarity_and_match_count(self.template_name, similarity_matrix, self.threshold,
-                                                  len(self.xyxy_boxes) > 0)
+                                                  len(self.xyxy_boxes) > 0, self.tracker)
         return detect_succeed, boxes_info
 
 
@@ -325,6 +551,9 @@ class FixedRegionDifferDetector(TemplateDetector):
 
         self.last_image = None
 
+    def is_stateful(self) -> bool:
+        return True
+
     def detect(self, full_screen_shot, show_detail) -> Tuple[bool, Union[None, dict]]:
         if self.last_image is None:
             return False, None
@@ -2,14 +2,15 @@ import math
 import time
 from abc import ABC, abstractmethod
 from enum import Enum
-from typing import List
+from typing import List, Tuple
 
 import cv2
 
 from src.android.adb import adb_text_input, KeyEvent, adb_key_event
-from src.android.capture import ScreenCapturer
 from src.android.capture.base import Capturer
 from src.android.operators.base import Operator
+from src.templates.bundle import TemplateImageStore
+from src.templates.imagecache import TemplateImageCache
 from src.templates.compare import search_template, MatchMethod
 from src.templates.gui.base import ConfigUI
 from src.templates.gui.utils import ScreenShotCropper
@@ -31,6 +32,28 @@ class TemplateOperation(ABC):
     def execute(self, operator: Operator, capturer: Capturer, dataset: dict):
         pass
 
+    def load_images(self):
+        """
+        预先把用到的图片读进缓存, 没有图片的操作什么都不做
+        """
+        pass
+
+    def cache_keys(self) -> List[Tuple]:
+        """
+        用到的图片在TemplateImageCache中的key, 所属模式激活时会被pin住
+        """
+        return []
+
+
+def _dataset_frame(capturer: Capturer, dataset: dict, fresh_capture=False):
+    """
+    默认复用本轮匹配时已经截好的 dataset["full_screen_shot"], 只有明确要求或者没有时才重新截图
+    """
+    full_screen_shot = dataset.get("full_screen_shot")
+    if fresh_capture or full_screen_shot is None:
+        full_screen_shot = capturer.capture()
+    return full_screen_shot
+
 
 """
 operations: [                    执行的操作，点、滑、截图、adb input等等
@@ -177,10 +200,10 @@ class ScreenShotOperation(TemplateOperation):
 
     def __init__(self, **kwargs):
         self.save_path_data_key = kwargs.get("save_path_data_key")
+        self.fresh_capture = kwargs.get("fresh_capture", False)  # 是否重新截图, 默认使用本轮匹配的截图
 
     def execute(self, operator: Operator, capturer: Capturer, dataset: dict):
-        screen_capturer: ScreenCapturer = capturer
-        image = screen_capturer.capture()
+        image = _dataset_frame(capturer, dataset, self.fresh_capture)
         save_path = dataset.get(self.save_path_data_key)
         cv2.imwrite(save_path, image)
 
@@ -255,12 +278,14 @@ class RecognizeNumberOperation(TemplateOperation):
         self.y1 = kwargs.get("y1")
         self.x2 = kwargs.get("x2")
         self.y2 = kwargs.get("y2")
+        self.fresh_capture = kwargs.get("fresh_capture", False)  # 是否重新截图, 默认使用本轮匹配的截图
 
     def execute(self, operator: Operator, capturer: Capturer, dataset: dict):
         img_num_splitter: ImageNumberSplitter = ImageNumberSplitter()
-        screen_capturer: ScreenCapturer = capturer
-        image = screen_capturer.capture()
-        region_image = image[self.y1: self.y2, self.x1: self.x2]
+        if self.fresh_capture:
+            region_image = capturer.capture_region(self.x1, self.y1, self.x2, self.y2)  # 只截需要识别的区域
+        else:
+            region_image = _dataset_frame(capturer, dataset)[self.y1: self.y2, self.x1: self.x2]
         numbers_info = img_num_splitter.split_numbers_boxes(region_image)
         dataset[self.number_key] = "".join(map(str, numbers_info["numbers"]))
 
@@ -302,7 +327,6 @@ class RepeatDragTillRegionExists(TemplateOperation):
 
     def __init__(self, **kwargs):
         self.search_target_path = kwargs.get("search_target")
-        self.template = cv2.imread(self.search_target_path)
         self.pixels_per_second = kwargs.get("speed", 300)  # 300 像素每秒
         self.interval = 0.01  # 操作帧率 为100Hz
         self.rx1 = kwargs.get("rx1")
@@ -314,12 +338,23 @@ class RepeatDragTillRegionExists(TemplateOperation):
         self.px2 = kwargs.get("px2")
         self.py2 = kwargs.get("py2")
 
+    @property
+    def template(self):
+        # 用到时才从共享的图片缓存里取
+        return TemplateImageCache().get((self.search_target_path, "image"),
+                                        lambda: TemplateImageStore().imread(self.search_target_path))
+
+    def load_images(self):
+        self.template
+
+    def cache_keys(self) -> List[Tuple]:
+        return [(self.search_target_path, "image")]
+
     def execute(self, operator: Operator, capturer: Capturer, dataset: dict):
-        screen_capturer: ScreenCapturer = capturer
+        screen_capturer = capturer
         @set_min_time(self.interval)
         def check_exists():
-            full_screen_shot = screen_capturer.capture()
-            region_img = full_screen_shot[self.ry1: self.ry2, self.rx1: self.rx2]
+            region_img = screen_capturer.capture_region(self.rx1, self.ry1, self.rx2, self.ry2)
             final_xyxy_boxes, sim_matrix = search_template(self.template, region_img, method=MatchMethod.TM_CCOEFF_NORMED)
             import numpy as np
             print(np.max(sim_matrix))
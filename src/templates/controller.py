@@ -4,8 +4,13 @@ from typing import List, Dict, Union, Set
 import keyboard
 
 from .template import TemplateModeManger, Template
+from .scheduler import PollingScheduler
+from .pipeline import TemplatePipeline
+from .metrics import MetricsExporter
 from ..android.capture import ScreenCapturer
 from ..android.operators.base import Operator
+from ..utils.time import StageTimeRecorder, Stage
+from ..utils.trace import ChromeTracer
 import yaml
 
 
@@ -20,13 +25,37 @@ class TemplateController:
                  show_state: Union[bool, None] = None):
         with open(ctrl_cfg_path, "r", encoding="utf8") as f:
             self.cfg = yaml.safe_load(f)
-        self.template_mode_manager = TemplateModeManger(self.cfg.get("modes"), full_screen_capturer, template_monitor_manager)
+        self.template_mode_manager = TemplateModeManger.from_cfg(self.cfg, full_screen_capturer,
+                                                                 template_monitor_manager)
 
         # init_args > cfg_args
         self.show_detect = show_detect if show_detect is not None else self.cfg.get("show_detect", None)
         self.show_history = show_history if show_history is not None else self.cfg.get("show_history", None)
         self.show_state = show_state if show_state is not None else self.cfg.get("show_state", None)
 
+        # 自适应轮询: 代替固定的no_detect等待和操作后的等待
+        self.scheduler = None
+        if self.cfg.get("adaptive_polling", False):
+            self.scheduler = PollingScheduler(min_interval=self.cfg.get("min_poll_interval", 0.05),
+                                              max_interval=self.cfg.get("max_poll_interval", 1.),
+                                              backoff=self.cfg.get("poll_backoff", 1.5))
+        # 执行完模板后到下一次截图至少等待的秒数, 为空时用interval_seconds
+        self.post_match_delay = self.cfg.get("post_match_delay", None)
+
+        # 各阶段耗时统计(截图、预处理、每个模板的检测、每类操作、等待)
+        if self.cfg.get("instrument", False):
+            StageTimeRecorder().enable(self.cfg.get("instrument_capacity", 1024))
+        # Chrome trace: 各阶段的span与状态池变化写进trace_file, 用Perfetto打开
+        if self.cfg.get("trace_file"):
+            StageTimeRecorder().tracer = ChromeTracer(self.cfg.get("trace_file"))
+        # 运行指标: 本地HTTP端口(/metrics)或定期重写的textfile, Prometheus文本格式
+        self.metrics_exporter = None
+        if self.cfg.get("metrics_port") is not None or self.cfg.get("metrics_textfile"):
+            self.metrics_exporter = MetricsExporter(self.template_mode_manager.metrics,
+                                                    port=self.cfg.get("metrics_port"),
+                                                    textfile=self.cfg.get("metrics_textfile"),
+                                                    interval=self.cfg.get("metrics_interval", 15))
+
         self.pause = False
         self.exit_work = False
 
@@ -50,6 +79,14 @@ class TemplateController:
         keyboard.add_hotkey(hotkey, self._exit_working)
 
     def run_once(self, operator, interval_seconds=0.5):
+        loop_start = time.perf_counter()
+        if self.scheduler is not None:
+            self._run_once_scheduled(operator, interval_seconds)
+        else:
+            self._run_once(operator, interval_seconds)
+        StageTimeRecorder().record(Stage.LOOP, "run_once", time.perf_counter() - loop_start, loop_start)
+
+    def _run_once(self, operator, interval_seconds):
         if not self.pause:
             self.template_mode_manager.match(show_detail=self.show_detect)
             if self.show_history:
@@ -61,6 +98,73 @@ class TemplateController:
         if self.pause:
             self.template_mode_manager.no_detect()
 
+    def settle_delay(self, interval_seconds):
+        """
+        执行完模板后到下一次截图至少等待的秒数
+        """
+        return interval_seconds if self.post_match_delay is None else self.post_match_delay
+
+    def _run_once_scheduled(self, operator, interval_seconds):
+        """
+        由调度器决定下一轮的时间: 空闲时的轮询间隔自适应调整, 执行完模板后至少等待settle_delay;
+        interval_seconds用于同一模板多个操作之间的等待
+        """
+        self.scheduler.begin()
+        if self.pause:
+            self.scheduler.update(matched=False)
+        else:
+            matched_template = self.template_mode_manager.match(show_detail=self.show_detect)
+            if self.show_history:
+                print("历史:", self.template_mode_manager.matched_template_recoder)
+            self.template_mode_manager.execute(operator, interval_seconds, idle_wait=False)
+            if self.show_state:
+                print("状态池", self.template_mode_manager.state_pool)
+            self.scheduler.update(matched=matched_template is not None,
+                                  frame_changed=self.template_mode_manager.frame_changed,
+                                  settle_delay=self.settle_delay(interval_seconds))
+            if self.show_detect:
+                print("调度:", self.scheduler)
+        self.scheduler.wait()
+
+    @property
+    def loop_rate(self):
+        """
+        实际达到的轮询频率(次/秒), 没有启用自适应轮询时为None
+        """
+        if self.scheduler is None:
+            return None
+        return self.scheduler.loop_rate
+
     def start(self, operator, interval_seconds=0.5):
-        while not self.exit_work:
-            self.run_once(operator, interval_seconds)
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.start()
+        try:
+            if self.cfg.get("pipelined", False):
+                self.start_pipelined(operator, interval_seconds, self.cfg.get("frame_buffer_size", 3))
+                return
+            while not self.exit_work:
+                self.run_once(operator, interval_seconds)
+        finally:
+            if self.metrics_exporter is not None:
+                self.metrics_exporter.stop()
+            self.dump_instrumentation()
+
+    def dump_instrumentation(self):
+        """
+        退出时打印各阶段耗时统计, 配置了instrument_dump时同时写成json; 关闭trace文件
+        """
+        recorder = StageTimeRecorder()
+        if recorder.tracer is not None:
+            recorder.tracer.close()
+            recorder.tracer = None
+        if not recorder.enabled:
+            return
+        print("耗时统计:\n" + recorder.report())
+        if self.cfg.get("instrument_dump"):
+            recorder.dump(self.cfg.get("instrument_dump"))
+
+    def start_pipelined(self, operator, interval_seconds=0.5, buffer_size=3):
+        """
+        截图、检测、执行分别在各自的线程上流水线运行, 见 TemplatePipeline
+        """
+        TemplatePipeline(self, operator, interval_seconds, buffer_size).run()
@@ -0,0 +1,117 @@
+import threading
+from collections import OrderedDict, Counter
+from typing import Hashable, Iterable, Union
+
+import numpy as np
+
+from src.utils.singleton import Singleton
+
+
+def _nbytes(value):
+    """
+    估算缓存项占用的字节数: 数组、数组列表, 或者带数组属性的对象(如StoredImage)
+    """
+    if value is None:
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(item) for item in value)
+    return sum(item.nbytes for item in vars(value).values() if isinstance(item, np.ndarray))
+
+
+@Singleton
+class TemplateImageCache:
+    """
+    模板图片按需加载的共享LRU缓存, 总字节数超过max_bytes时从最久没用的开始淘汰。
+    激活模式的图片被pin住不会淘汰, 模式关闭后unpin, 变成可淘汰的
+    """
+
+    def __init__(self, max_bytes: Union[int, None] = None):
+        """
+        :param max_bytes: 缓存上限, None表示不限制(仍然是用到时才加载)
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, 字节数), 越靠后越新
+        self._pins = Counter()  # key -> pin的次数
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def configure(self, max_bytes: Union[int, None]):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def get(self, key: Hashable, compute):
+        """
+        :param compute: 无参函数, 不在缓存里时调用它加载
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        value = compute()  # 加载时不持锁, 并行检测时可能重复加载, 保留先写入的
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+            self.misses += 1
+            nbytes = _nbytes(value)
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            self._evict()
+        return value
+
+    def pin(self, keys: Iterable[Hashable]):
+        with self._lock:
+            self._pins.update(keys)
+
+    def unpin(self, keys: Iterable[Hashable]):
+        with self._lock:
+            self._pins.subtract(keys)
+            self._pins = +self._pins  # 去掉计数<=0的
+            self._evict()
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        for key in list(self._entries.keys()):
+            if self.current_bytes <= self.max_bytes:
+                break
+            if self._pins[key] > 0:
+                continue
+            _, nbytes = self._entries.pop(key)
+            self.current_bytes -= nbytes
+            self.evictions += 1
+            self.evicted_bytes += nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        limit = "不限" if self.max_bytes is None else f"{self.max_bytes / 2 ** 20:.1f}MB"
+        return (f"图片缓存: {len(self._entries)}项 {self.current_bytes / 2 ** 20:.1f}MB/{limit}, "
+                f"命中{self.hits}, 加载{self.misses}, 淘汰{self.evictions}({self.evicted_bytes / 2 ** 20:.1f}MB)")
+
+
+if __name__ == "__main__":
+    # 上限3MB, 每张1MB: pin住的两张不会被淘汰, 其余按LRU淘汰
+    cache = TemplateImageCache(max_bytes=3 * 2 ** 20)
+    cache.pin(["a", "b"])
+    for name in ["a", "b", "c", "d", "e", "a", "c"]:
+        cache.get(name, lambda: np.zeros(2 ** 20, dtype=np.uint8))
+        print(name, cache)
+    cache.unpin(["a", "b"])
+    print("unpin", cache)
@@ -0,0 +1,218 @@
+"""运行指标
+TemplateModeManger维护计数器, MetricsExporter按Prometheus文本格式导出:
+本地HTTP端口(/metrics), 或者定期重写一个textfile(给node_exporter的textfile collector读)。
+计数器都在初始化时按模板建好, 每轮只做加法, 不分配新对象
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Union
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5)  # 秒
+
+
+class LatencyHistogram:
+    """
+    固定桶的耗时直方图, counts[i]是落在 (buckets[i-1], buckets[i]] 的次数, 最后一个是超过最大桶的
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def prometheus_lines(self, name, labels=""):
+        """
+        :param labels: 形如 'template="a"', 不带花括号
+        """
+        sep = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class ManagerMetrics:
+    """
+    TemplateModeManger的计数器。模板的检测耗时直方图放在Template.detect_histogram里
+    """
+
+    def __init__(self, templates: Iterable):
+        """
+        :param templates: (模式名, 模板), 不同模式里的模板可以重名
+        """
+        self.labels = {template: f'mode="{_escape(mode_name)}",template="{_escape(template.template_name)}"'
+                       for mode_name, template in templates}
+        self.templates = list(self.labels)
+        self.loops = 0
+        self.match_counts = {template: 0 for template in self.templates}
+        self.operation_failures = {template: 0 for template in self.templates}
+        self.capture_histogram = LatencyHistogram()
+        self.started_at = time.perf_counter()
+        self._last_render = (self.started_at, 0)  # (时间, 当时的loops), 用来算两次导出之间的频率
+
+    def record_match(self, template):
+        self.loops += 1
+        if template is not None:
+            self.match_counts[template] += 1
+
+    def render_prometheus(self):
+        now = time.perf_counter()
+        last_time, last_loops = self._last_render
+        self._last_render = (now, self.loops)
+        loop_rate = (self.loops - last_loops) / (now - last_time) if now > last_time else 0.
+
+        lines = ["# HELP template_loops_total 匹配轮数",
+                 "# TYPE template_loops_total counter",
+                 f"template_loops_total {self.loops}",
+                 "# HELP template_loop_rate 距上次导出的平均匹配频率(次/秒)",
+                 "# TYPE template_loop_rate gauge",
+                 f"template_loop_rate {loop_rate}",
+                 "# HELP template_uptime_seconds 运行时间",
+                 "# TYPE template_uptime_seconds gauge",
+                 f"template_uptime_seconds {now - self.started_at}",
+                 "# HELP template_capture_seconds 截图耗时",
+                 "# TYPE template_capture_seconds histogram"]
+        lines += self.capture_histogram.prometheus_lines("template_capture_seconds")
+
+        lines += ["# HELP template_detect_total 模板检测次数(不含沿用上次结果)",
+                  "# TYPE template_detect_total counter"]
+        for template in self.templates:
+            lines.append(f"template_detect_total{{{self.labels[template]}}} {template.detect_count}")
+        lines += ["# HELP template_detect_seconds 模板检测耗时",
+                  "# TYPE template_detect_seconds histogram"]
+        for template in self.templates:
+            lines += template.detect_histogram.prometheus_lines("template_detect_seconds", self.labels[template])
+        tracked = [template for template in self.templates if getattr(template.detector, "tracker", None) is not None]
+        for name, attr, help_text in (("hits", "hit_count", "跟踪窗口命中, 省掉了全区域搜索的次数"),
+                                      ("misses", "miss_count", "跟踪窗口没搜到、退回全区域搜索的次数"),
+                                      ("full_searches", "full_search_count", "全区域搜索的次数")):
+            if not tracked:
+                break
+            lines += [f"# HELP template_track_{name}_total {help_text}",
+                      f"# TYPE template_track_{name}_total counter"]
+            for template in tracked:
+                lines.append(f"template_track_{name}_total{{{self.labels[template]}}} "
+                             f"{getattr(template.detector.tracker, attr)}")
+        lines += ["# HELP template_match_total 模板被选为本轮结果的次数",
+                  "# TYPE template_match_total counter"]
+        for template, count in self.match_counts.items():
+            lines.append(f"template_match_total{{{self.labels[template]}}} {count}")
+        lines += ["# HELP template_operation_failures_total 操作执行抛出异常的次数",
+                  "# TYPE template_operation_failures_total counter"]
+        for template, count in self.operation_failures.items():
+            lines.append(f"template_operation_failures_total{{{self.labels[template]}}} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """
+    导出ManagerMetrics: port不为None时在本地起HTTP服务(GET /metrics), textfile不为空时每interval秒重写一次
+    """
+
+    def __init__(self, metrics: ManagerMetrics, port: Union[int, None] = None, textfile=None, interval=15.,
+                 host="127.0.0.1"):
+        self.metrics = metrics
+        self.port = port
+        self.textfile = textfile
+        self.interval = interval
+        self.host = host
+        self._server = None
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()  # render会更新上次导出的时间, HTTP与textfile可能同时导出
+
+    def render(self):
+        with self._lock:
+            return self.metrics.render_prometheus()
+
+    def _serve(self):
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.port = self._server.server_address[1]  # port=0 时由系统分配
+        thread = threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def write_textfile(self):
+        # 先写临时文件再替换, 读的一方不会读到写了一半的文件
+        tmp_path = f"{self.textfile}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, self.textfile)
+
+    def _textfile_loop(self):
+        while not self._stop.wait(self.interval):
+            self.write_textfile()
+
+    def start(self):
+        if self.port is not None:
+            self._serve()
+        if self.textfile:
+            self.write_textfile()
+            thread = threading.Thread(target=self._textfile_loop, name="metrics-textfile", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self.textfile:
+            self.write_textfile()
+
+
+if __name__ == "__main__":
+    # 用法: python -m src.templates.metrics cfg.yaml 截图目录 [端口]
+    # 回放截图并在本地端口提供/metrics, 回放结束后保持服务直到Ctrl+C
+    import sys
+
+    from .replay import ReplayBenchmark, _frame_capturer
+
+    benchmark = ReplayBenchmark.from_cfg(sys.argv[1], _frame_capturer(sys.argv[2]))
+    exporter = MetricsExporter(benchmark.manager.metrics, port=int(sys.argv[3]) if len(sys.argv) > 3 else 0)
+    exporter.start()
+    print(f"http://{exporter.host}:{exporter.port}/metrics")
+    benchmark.run()
+    print(exporter.render())
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        exporter.stop()
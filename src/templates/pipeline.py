@@ -0,0 +1,197 @@
+import threading
+import time
+from collections import deque
+from typing import Union, Tuple
+
+from ..android.operators.base import Operator
+from ..utils.time import StageTimeRecorder, Stage
+
+
+class FrameRingBuffer:
+    """
+    截图环形缓冲: 截图线程不断写入, 检测只取最新的一帧, 旧帧被自动丢弃
+    """
+
+    def __init__(self, capacity=3):
+        self._frames = deque(maxlen=capacity)  # (序号, 开始截图的时间, 图像)
+        self._condition = threading.Condition()
+        self._seq = 0
+        self._consumed_seq = 0  # 检测最近取走的帧序号
+        self._waiting = 0  # 正在latest里等新帧的检测数
+        self.closed = False  # 截图结束(如图片目录读完), 不会再有新帧
+
+    def put(self, frame, captured_at):
+        """
+        :param captured_at: 开始截图的时间(perf_counter), 用来判断这帧是否在某次操作之后
+        """
+        with self._condition:
+            self._seq += 1
+            self._frames.append((self._seq, captured_at, frame))
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def wait_for_demand(self, prefetch=True):
+        """
+        截图线程在截下一帧前调用: 检测正在等新帧时立即返回; prefetch为True时, 上一帧已被取走也返回(与检测重叠地预截一帧)。
+        暂停、调度器放慢时没有检测来取帧, 截图线程就停在这里
+        :return: 缓冲已关闭时返回False
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.closed or self._waiting > 0 or
+                                     (prefetch and self._seq <= self._consumed_seq))
+            return not self.closed
+
+    def latest(self, after_seq=0, captured_after=0.) -> Union[Tuple[int, float, object], None]:
+        """
+        等待并返回最新的一帧, 要求序号大于after_seq且在captured_after之后才开始截图
+        :return: (序号, 开始截图的时间, 图像), 缓冲已关闭且没有满足条件的帧时返回None
+        """
+        with self._condition:
+            self._waiting += 1
+            try:
+                while True:
+                    if self._frames:
+                        seq, captured_at, frame = self._frames[-1]
+                        if seq > after_seq and captured_at >= captured_after:
+                            self._consumed_seq = seq
+                            self._condition.notify_all()
+                            return seq, captured_at, frame
+                    if self.closed:
+                        return None
+                    self._condition.notify_all()  # 唤醒等待需求的截图线程
+                    self._condition.wait()
+            finally:
+                self._waiting -= 1
+
+
+class LockedCapturer:
+    """
+    截图线程与操作(fresh_capture、capture_region)共用一个截图器时, 它们会操作同一组GDI对象, 用锁串行化
+    """
+
+    def __init__(self, capturer):
+        self.capturer = capturer
+        self.lock = threading.Lock()
+
+    def capture(self):
+        with self.lock:
+            return self.capturer.capture()
+
+    def capture_region(self, x1, y1, x2, y2):
+        with self.lock:
+            return self.capturer.capture_region(x1, y1, x2, y2)
+
+    def __getattr__(self, item):
+        return getattr(self.capturer, item)
+
+
+class TemplatePipeline:
+    """
+    流水线运行: 截图线程持续截图到环形缓冲, 检测与执行在调用线程上依次进行, 检测只处理最新一帧。
+    只有截图与检测、执行重叠, 截图的延迟不再叠加在每一轮上; 检测与执行不会同时进行, 状态池只会被一个线程修改。
+    执行完模板后, 之后的检测只使用操作完成settle_delay秒后才开始截取的帧, 不会对操作前或界面还没反应过来的画面重复匹配。
+    截图按需进行: 最多比检测多预截一帧, 启用自适应轮询时只在检测需要时截图; 暂停时不截图。
+    截图线程中的异常会在调用线程上重新抛出
+    """
+
+    def __init__(self, controller, operator: Operator, interval_seconds=0.5, buffer_size=3):
+        self.controller = controller
+        self.manager = controller.template_mode_manager
+        self.operator = operator
+        self.interval_seconds = interval_seconds
+        self.frames = FrameRingBuffer(buffer_size)
+
+        self._stop = threading.Event()
+        self._error: Union[BaseException, None] = None  # 截图线程中的异常, 由调用线程重新抛出
+        self._capturer = None  # 运行期间截图线程与操作共用的加锁截图器
+        self._capture_thread = threading.Thread(target=self._capture_loop, name="pipeline-capture", daemon=True)
+
+        self.captured_frames = 0
+        self.detected_frames = 0
+
+    def _capture_loop(self):
+        capturer = self._capturer
+        prefetch = self.controller.scheduler is None  # 调度器会等待, 预截的帧到检测时已经过时
+        try:
+            while not self._stop.is_set() and self.frames.wait_for_demand(prefetch):
+                captured_at = time.perf_counter()
+                frame = capturer.capture()
+                if frame is None:
+                    break
+                capture_seconds = time.perf_counter() - captured_at
+                self.manager.metrics.capture_histogram.observe(capture_seconds)
+                StageTimeRecorder().record(Stage.CAPTURE, type(capturer.capturer).__name__, capture_seconds,
+                                           captured_at)
+                self.frames.put(frame, captured_at)
+                self.captured_frames += 1
+        except BaseException as e:
+            self._error = e
+        finally:
+            self.frames.close()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _detect_once(self, after_seq, captured_after):
+        """
+        :return: 用掉的帧序号, 没有新帧时返回None
+        """
+        latest = self.frames.latest(after_seq, captured_after)
+        if latest is None:
+            self._raise_error()
+            return None
+        seq, _, frame = latest
+        matched_template = self.manager.match(show_detail=self.controller.show_detect, full_screen_img=frame)
+        self.detected_frames += 1
+        if self.controller.show_history:
+            print("历史:", self.manager.matched_template_recoder)
+        # 没有匹配也要调用, 通知监视器
+        self.manager.execute(self.operator, self.interval_seconds, idle_wait=False)
+        if matched_template is not None and self.controller.show_state:
+            print("状态池", self.manager.state_pool)
+        return seq
+
+    def run(self):
+        # 运行期间操作也通过加锁的截图器截图, 结束后换回原来的
+        original_capturer = self.manager.screen_capturer
+        self._capturer = LockedCapturer(original_capturer)
+        self.manager.screen_capturer = self._capturer
+        self._capture_thread.start()
+        scheduler = self.controller.scheduler
+        after_seq, captured_after = 0, 0.
+        try:
+            while not self.controller.exit_work:
+                if self.controller.pause:
+                    self.manager.no_detect()
+                    continue
+                if scheduler is not None:
+                    scheduler.begin()
+                loop_start = time.perf_counter()
+                seq = self._detect_once(after_seq, captured_after)
+                if seq is None:
+                    break
+                StageTimeRecorder().record(Stage.LOOP, "pipeline", time.perf_counter() - loop_start,
+                                       loop_start)
+                after_seq = seq
+                settle_delay = self.controller.settle_delay(self.interval_seconds)
+                if self.manager.matched_template is not None:
+                    captured_after = time.perf_counter() + settle_delay  # 执行时不在最后一个操作后等待
+                if scheduler is not None:
+                    scheduler.update(matched=self.manager.matched_template is not None,
+                                     frame_changed=self.manager.frame_changed, settle_delay=settle_delay)
+                    scheduler.wait()
+        finally:
+            self.stop()
+            self.manager.screen_capturer = original_capturer
+
+    def stop(self):
+        self._stop.set()
+        self.frames.close()  # 唤醒等待需求的截图线程
+        if self._capture_thread.is_alive():
+            self._capture_thread.join()
@@ -0,0 +1,194 @@
+"""离线回放
+用录好的截图(ImageDirCapturer)或视频(VideoCapturer)驱动TemplateModeManger, 不需要模拟器窗口, 也不sleep。
+统计每帧的端到端耗时分位数、每个模板的检测耗时、每帧的匹配结果和状态池轨迹,
+用来在同一段录像上比较配置或引擎的改动。
+
+用法:
+    python -m src.templates.replay cfg.yaml 截图目录或视频 [--states s1 s2] [--operate] [--out report.json]
+"""
+import json
+import os
+import time
+from typing import List, Union, Iterable
+
+import numpy as np
+import yaml
+
+from .template import TemplateModeManger
+from ..android.capture.base import Capturer
+from ..utils.time import StageTimeRecorder, Stage
+from ..utils.trace import ChromeTracer
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+class ReplayReport:
+    def __init__(self):
+        self.frame_seconds: List[float] = []  # 每帧 检测+执行 的耗时
+        self.decisions: List[Union[str, None]] = []  # 每帧匹配到的模板名
+        self.state_trajectory: List[List[str]] = []  # 每帧执行后的状态池(排好序)
+        self.template_stats = {}  # 模式名/模板名 -> {"count": 检测次数, "seconds": 累计耗时, "track": 跟踪命中统计}
+        self.total_seconds = 0.
+
+    def latency_percentiles(self):
+        """
+        :return: {"p50": 毫秒, ..., "mean": 毫秒, "max": 毫秒}
+        """
+        if not self.frame_seconds:
+            return {}
+        frame_ms = np.array(self.frame_seconds) * 1000
+        percentiles = {f"p{p}": float(v) for p, v in zip(PERCENTILES, np.percentile(frame_ms, PERCENTILES))}
+        percentiles.update({"mean": float(np.mean(frame_ms)), "max": float(np.max(frame_ms))})
+        return percentiles
+
+    def to_dict(self):
+        return {
+            "frames": len(self.frame_seconds),
+            "total_seconds": self.total_seconds,
+            "latency_ms": self.latency_percentiles(),
+            "templates": self.template_stats,
+            "decisions": self.decisions,
+            "states": self.state_trajectory,
+        }
+
+    def __str__(self):
+        lines = [f"回放 {len(self.frame_seconds)} 帧, 总耗时 {self.total_seconds:.3f}s"]
+        lines.append("每帧耗时(ms): " + ", ".join(f"{k}={v:.2f}" for k, v in self.latency_percentiles().items()))
+        lines.append("模板检测耗时(按累计耗时排序):")
+        for name, stats in sorted(self.template_stats.items(), key=lambda item: -item[1]["seconds"]):
+            mean_ms = stats["seconds"] / stats["count"] * 1000 if stats["count"] else 0.
+            track_info = ""
+            if "track" in stats:
+                track = stats["track"]
+                track_info = f", 跟踪命中{track['hit']}/未命中{track['miss']}/全区域{track['full']}"
+            lines.append(f"    {name}: {stats['count']}次, 累计{stats['seconds'] * 1000:.2f}ms, 平均{mean_ms:.3f}ms"
+                         f"{track_info}")
+        matched = [decision for decision in self.decisions if decision is not None]
+        lines.append(f"匹配: {len(matched)}/{len(self.decisions)} 帧")
+        return "\n".join(lines)
+
+
+class ReplayBenchmark:
+    """
+    按帧回放: 匹配 -> (执行) -> 更新状态池。默认不执行操作, 只按模板配置更新状态池,
+    避免adb、拖拽等操作的副作用和等待; run_operations=True时用NullOperator执行, 间隔为0
+    """
+
+    def __init__(self, manager: TemplateModeManger, run_operations=False):
+        self.manager = manager
+        self.run_operations = run_operations
+        self._operator = None
+        if run_operations:
+            from ..android.operators.devices import NullOperator
+            self._operator = NullOperator()
+
+    @classmethod
+    def from_cfg(cls, cfg_path, capturer: Capturer, initial_states: Iterable = (), dataset: dict = None,
+                 run_operations=False):
+        with open(cfg_path, "r", encoding="utf8") as f:
+            cfg = yaml.safe_load(f)
+        manager = TemplateModeManger.from_cfg(cfg, capturer)
+        manager.update_state_pool(initial_states)
+        if dataset:
+            manager.update_dataset(dataset)
+        return cls(manager, run_operations)
+
+    def _templates(self):
+        """
+        :return: (模式名/模板名, 模板), 不同模式里的模板可以重名
+        """
+        for template_mode in self.manager.template_modes.values():
+            for template in template_mode.templates.values():
+                yield f"{template_mode.mode_name}/{template.template_name}", template
+
+    def run(self, max_frames=None) -> ReplayReport:
+        manager = self.manager
+        report = ReplayReport()
+        start_stats = {name: (template, template.detect_count, template.detect_seconds, _track_counts(template))
+                       for name, template in self._templates()}
+        run_start = time.perf_counter()
+        while max_frames is None or len(report.frame_seconds) < max_frames:
+            capture_start = time.perf_counter()
+            frame = manager.screen_capturer.capture()  # 读帧不计入每帧耗时
+            if frame is None:
+                break
+            capture_seconds = time.perf_counter() - capture_start
+            manager.metrics.capture_histogram.observe(capture_seconds)
+            StageTimeRecorder().record(Stage.CAPTURE, type(manager.screen_capturer).__name__, capture_seconds,
+                                       capture_start)
+            frame_start = time.perf_counter()
+            matched_template = manager.match(full_screen_img=frame)
+            if matched_template is not None:
+                if self.run_operations:
+                    manager.execute(self._operator, 0., idle_wait=False)
+                else:
+                    matched_template.update_state_pool(manager.state_pool)
+                    manager.matched_template_recoder.update_record(matched_template.template_name)
+            report.frame_seconds.append(time.perf_counter() - frame_start)
+            report.decisions.append(None if matched_template is None else matched_template.template_name)
+            report.state_trajectory.append(sorted(map(str, manager.state_pool)))
+        report.total_seconds = time.perf_counter() - run_start
+        for name, (template, count, seconds, track_counts) in start_stats.items():
+            report.template_stats[name] = {"count": template.detect_count - count,
+                                           "seconds": template.detect_seconds - seconds}
+            if track_counts is not None:
+                report.template_stats[name]["track"] = {key: value - track_counts[key]
+                                                        for key, value in _track_counts(template).items()}
+        return report
+
+
+def _track_counts(template):
+    """
+    :return: 检测器跟踪窗口的命中计数, 没有启用跟踪时返回None
+    """
+    tracker = getattr(template.detector, "tracker", None)
+    if tracker is None:
+        return None
+    return {"hit": tracker.hit_count, "miss": tracker.miss_count, "full": tracker.full_search_count}
+
+
+def _frame_capturer(source, sample_fps=None):
+    if os.path.isdir(source):
+        from ..android.capture.image import ImageDirCapturer
+        return ImageDirCapturer(source)
+    import cv2
+    from ..android.capture.video import VideoCapturer
+    video = cv2.VideoCapture(source)
+    w, h = int(video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = video.get(cv2.CAP_PROP_FPS)
+    video.release()
+    return VideoCapturer(0, 0, w, h, source, sample_fps=sample_fps or fps)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="离线回放模板匹配")
+    parser.add_argument("cfg", help="cfg.yaml")
+    parser.add_argument("source", help="截图目录(文件名为帧序号)或视频文件")
+    parser.add_argument("--states", nargs="*", default=[], help="初始状态池")
+    parser.add_argument("--frames", type=int, default=None, help="最多回放多少帧")
+    parser.add_argument("--fps", type=float, default=None, help="视频的采样帧率, 默认为视频帧率")
+    parser.add_argument("--operate", action="store_true", help="用NullOperator执行操作")
+    parser.add_argument("--out", default=None, help="报告json的输出路径")
+    parser.add_argument("--instrument", action="store_true", help="同时输出各阶段耗时统计")
+    parser.add_argument("--trace", default=None, help="Chrome trace json的输出路径")
+    args = parser.parse_args()
+
+    if args.trace:
+        StageTimeRecorder().tracer = ChromeTracer(args.trace)
+
+    if args.instrument:
+        StageTimeRecorder().enable()
+
+    benchmark = ReplayBenchmark.from_cfg(args.cfg, _frame_capturer(args.source, args.fps), args.states,
+                                         run_operations=args.operate)
+    replay_report = benchmark.run(args.frames)
+    print(replay_report)
+    if args.instrument:
+        print(StageTimeRecorder().report())
+    if args.trace:
+        StageTimeRecorder().tracer.close()
+    if args.out:
+        with open(args.out, "w", encoding="utf8") as f:
+            json.dump(replay_report.to_dict(), f, ensure_ascii=False, indent=2)
@@ -0,0 +1,94 @@
+import time
+from collections import deque
+
+from ..utils.time import StageTimeRecorder, Stage
+
+
+class PollingScheduler:
+    """
+    自适应轮询间隔: 连续空闲时按backoff倍数放慢, 匹配到模板或画面有变化时立刻收紧到min_interval。
+    间隔的计时从本轮开始算起, 检测与执行已经花掉的时间会从等待中扣除。
+    匹配到模板时另有一个从执行完毕算起的等待(settle_delay), 给界面反应的时间, 不随空闲调整
+    """
+
+    def __init__(self, min_interval=0.05, max_interval=1., backoff=1.5, rate_window=50):
+        """
+        :param min_interval: 最短轮询间隔(秒)
+        :param max_interval: 最长轮询间隔(秒)
+        :param backoff: 每次空闲后间隔放大的倍数
+        :param rate_window: 统计轮询频率用的最近轮数
+        """
+        assert 0 <= min_interval <= max_interval, "需要 0 <= min_interval <= max_interval"
+        assert backoff >= 1, "backoff 不能小于1"
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.idle_streak = 0  # 连续空闲的轮数
+        self._loop_start = None
+        self._settle_until = 0.  # 执行完模板后, 下一轮最早开始的时间
+        self._loop_timestamps = deque(maxlen=rate_window)
+
+    def begin(self):
+        """
+        一轮开始时调用
+        """
+        self._loop_start = time.perf_counter()
+        self._loop_timestamps.append(self._loop_start)
+
+    def update(self, matched, frame_changed=False, settle_delay=0.):
+        """
+        根据本轮结果更新间隔, 在执行完模板的操作后调用
+        :param matched: 本轮是否匹配到模板
+        :param frame_changed: 本轮截图与上一轮相比是否有变化
+        :param settle_delay: 匹配到模板时, 从现在起至少等待的秒数(操作之后界面需要时间反应)
+        :return: 新的间隔
+        """
+        if matched:
+            self._settle_until = time.perf_counter() + settle_delay
+        if matched or frame_changed:
+            self.idle_streak = 0
+            self.interval = self.min_interval
+        else:
+            self.idle_streak += 1
+            self.interval = min(self.max_interval, max(self.interval, self.min_interval) * self.backoff)
+        return self.interval
+
+    def wait(self):
+        """
+        等到本轮开始后interval秒, 且不早于执行完模板后的settle_delay
+        """
+        start = time.perf_counter()
+        if self._loop_start is None:
+            remaining = self.interval
+        else:
+            remaining = self.interval - (start - self._loop_start)
+        remaining = max(remaining, self._settle_until - start)
+        if remaining > 0:
+            time.sleep(remaining)
+        StageTimeRecorder().record(Stage.SLEEP, "scheduler", time.perf_counter() - start, start)
+
+    @property
+    def loop_rate(self):
+        """
+        最近rate_window轮的实际轮询频率(次/秒)
+        """
+        if len(self._loop_timestamps) < 2:
+            return 0.
+        elapsed = self._loop_timestamps[-1] - self._loop_timestamps[0]
+        if elapsed <= 0:
+            return 0.
+        return (len(self._loop_timestamps) - 1) / elapsed
+
+    def __str__(self):
+        return f"间隔: {self.interval:.3f}s, 连续空闲: {self.idle_streak}, 频率: {self.loop_rate:.2f}次/s"
+
+
+if __name__ == "__main__":
+    # 模拟: 空闲一段时间后出现匹配, 观察间隔的放大与收紧
+    scheduler = PollingScheduler(min_interval=0.01, max_interval=0.2, backoff=2)
+    for i in range(12):
+        scheduler.begin()
+        scheduler.update(matched=(i == 8), settle_delay=0.3)
+        print(i, scheduler)
+        scheduler.wait()
@@ -1,15 +1,22 @@
 import json
 import time
-from typing import List, Dict, Union, Set
-
-from .common import MatchedTemplateRecorder
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Dict, Union, Set, Tuple
+
+from .bundle import TemplateImageStore, load_bundle
+from .imagecache import TemplateImageCache
+from .metrics import LatencyHistogram, ManagerMetrics
+from .common import MatchedTemplateRecorder, StatePool, FrameFingerprint, FrameCache
 from .components.commoninfo import TemplateCommonInfo
 from .components.detectors import TemplateDetector
 from .components.factory import DetectorFactory, OperationFactory, CommonInfoFactory
 from .components.monitors import TemplateMonitorManager
 from .components.operations import TemplateOperation
-from ..android.capture import ScreenCapturer
+from ..android.capture.base import Capturer
 from ..android.operators.base import Operator
+from ..utils.time import StageTimeRecorder, Stage
 
 
 class Template:
@@ -31,24 +38,92 @@ class Template:
             operation = OperationFactory.parse_operation(operation_config)
             self.operations.append(operation)
 
+        # 画面变化门控: 上次检测时区域的指纹和结果
+        self._last_region_key = None
+        self._last_detect_result = None
+        # 累计检测耗时(不含沿用上次结果的轮次)
+        self.detect_seconds = 0.
+        self.detect_count = 0
+        self.detect_histogram = LatencyHistogram()
+        # 检测器被合并时, 原先持有它的模板名
+        self.shared_detector_of = None
+
     def check_valid(self, state_pool: set):
         return state_pool.issuperset(self.common_info.precondition)
 
-    def detect(self, full_screen_shot, dataset, update_dataset=True, show_detail=False):
+    def detect(self, full_screen_shot, dataset, update_dataset=True, show_detail=False,
+               fingerprint: FrameFingerprint = None):
         # print(self.template_name,end=": ")
-        detect_exist, detect_data_dict = self.detector.detect(full_screen_shot, show_detail)
+        detect_exist, detect_data_dict = self.evaluate(full_screen_shot, show_detail, fingerprint)
         if update_dataset and detect_data_dict is not None:
             dataset.update(detect_data_dict)
         return detect_exist
 
-    def operate(self, operator, capturer, dataset, interval_seconds):
-        for operation in self.operations:
+    def evaluate(self, full_screen_shot, show_detail=False, fingerprint: FrameFingerprint = None):
+        """
+        只做检测不写dataset, 可以在线程池里并行调用, 结果由调用方按顺序合并
+        :return: detect_exist, detect_data_dict
+        """
+        region_key = None
+        if fingerprint is not None:
+            region_key = fingerprint.region_key(self.detector.detect_region())
+        if region_key is not None and region_key == self._last_region_key:
+            # 检测区域与上次完全一样, 沿用上次结果
+            detect_exist, detect_data_dict = self._last_detect_result
+            if show_detail:
+                print(f"检测: [{self.template_name}区域未变化]. Detect: {detect_exist}")
+        else:
+            # 多个模板共用一个检测器时, 每帧只检测一次
+            start = time.perf_counter()
+            detect_exist, detect_data_dict = FrameCache().get(full_screen_shot, ("detect", self.detector),
+                                                              lambda: self.detector.detect(full_screen_shot,
+                                                                                           show_detail))
+            detect_seconds = time.perf_counter() - start
+            self.detect_seconds += detect_seconds
+            self.detect_count += 1
+            self.detect_histogram.observe(detect_seconds)
+            StageTimeRecorder().record(Stage.DETECT, self.template_name, detect_seconds, start)
+            if show_detail and self.shared_detector_of is not None:
+                # 检测器自己打印的是第一个用到它的模板名
+                print(f"检测: [{self.template_name}]共用[{self.shared_detector_of}]的检测器. Detect: {detect_exist}")
+            self._last_region_key = region_key
+            self._last_detect_result = (detect_exist, detect_data_dict)
+        return detect_exist, detect_data_dict
+
+    def operate(self, operator, capturer, dataset, interval_seconds, sleep_after_last=True):
+        """
+        :param sleep_after_last: 最后一个操作之后是否也等待interval_seconds, 由调度器控制下一轮时间时可以不等
+        """
+        recorder = StageTimeRecorder()
+        for i, operation in enumerate(self.operations):
+            start = time.perf_counter()
             operation.execute(operator, capturer, dataset)
-            time.sleep(interval_seconds)
+            recorder.record(Stage.OPERATE, type(operation).__name__, time.perf_counter() - start, start,
+                            {"template": self.template_name})
+            if sleep_after_last or i < len(self.operations) - 1:
+                start = time.perf_counter()
+                time.sleep(interval_seconds)
+                recorder.record(Stage.SLEEP, "operate_interval", time.perf_counter() - start, start)
+
+    def load_images(self):
+        self.detector.load_images()
+        for operation in self.operations:
+            operation.load_images()
+
+    def cache_keys(self):
+        """
+        检测器和操作用到的图片在TemplateImageCache中的key
+        """
+        return self.detector.cache_keys() + [key for operation in self.operations for key in operation.cache_keys()]
 
     def update_state_pool(self, state_pool):
         self.consume_state_pool(state_pool)
         self.push_state_pool(state_pool)
+        tracer = StageTimeRecorder().tracer
+        if tracer is not None:
+            tracer.instant("state", self.template_name, {"consume": sorted(map(str, self.common_info.consume)),
+                                                         "outcome": sorted(map(str, self.common_info.outcome)),
+                                                         "state_pool": sorted(map(str, state_pool))})
 
     def push_state_pool(self, state_pool):
         state_pool.update(self.common_info.outcome)
@@ -57,25 +132,93 @@ class Template:
         state_pool.difference_update(self.common_info.consume)
 
 
+IMAGE_PATH_KEYS = ("template_image", "search_target")  # 检测器、操作配置中指向图片的参数
+
+
+def _missing_images(templates_config: dict) -> List[str]:
+    """
+    :return: 读不到的图片, 每项为 "模板名.参数: 路径"
+    """
+    store = TemplateImageStore()
+    missing = []
+    for template_name, template_config in templates_config.items():
+        components = [template_config.get("detector") or {}] + list(template_config.get("operations") or [])
+        for component in components:
+            kwargs = component.get("kwargs") or {}
+            for key in IMAGE_PATH_KEYS:
+                image_path = kwargs.get(key)
+                if image_path and not store.has_image(image_path):
+                    missing.append(f"{template_name}.{key}: {image_path}")
+    return missing
+
+
 class TemplateMode:
-    def __init__(self, mode_config_file):
-        with open(mode_config_file, "r", encoding="utf8") as f:
-            mode_config = json.load(f)
+    def __init__(self, mode_config_file, load_workers=None):
+        """
+        :param load_workers: 并行加载模板图片的线程数, None为ThreadPoolExecutor的默认值, 1为串行
+        """
+        mode_config = TemplateImageStore().mode_config(mode_config_file)  # 加载了bundle时不再解析json
 
         self.mode_name = mode_config.get("mode_name")
         self.activated = mode_config.get("init_activated")
         templates_config = mode_config.get("templates")
+        # 先检查所有图片, 一次报出全部缺失的文件, 而不是等imread返回None后在检测时才出错
+        missing = _missing_images(templates_config)
+        if missing:
+            raise FileNotFoundError(f"模式 {self.mode_name}({mode_config_file}) 缺少 {len(missing)} 个图片:\n"
+                                    + "\n".join(missing))
+        # 图片是用到时才加载的(TemplateImageCache), 构建模板本身很快
         self.templates = {}
         for template_name, template_config in templates_config.items():
             self.templates[template_name] = Template(template_name, template_config)
+        self.load_workers = load_workers
+        self._pinned_keys = None  # 激活时pin住的图片缓存key
+
+    def load_images(self):
+        """
+        把本模式用到的图片读进缓存; cv2.imread等会释放GIL, 在线程池里并行读
+        """
+        templates = list(self.templates.values())
+        if self.load_workers == 1 or len(templates) <= 1:
+            for template in templates:
+                template.load_images()
+            return
+        with ThreadPoolExecutor(max_workers=self.load_workers, thread_name_prefix="load") as executor:
+            list(executor.map(Template.load_images, templates))  # 取结果, 让加载时的异常抛出来
+
+    def pin_images(self):
+        """
+        激活的模式的图片不会被缓存淘汰
+        """
+        if self._pinned_keys is None:
+            self._pinned_keys = [key for template in self.templates.values() for key in template.cache_keys()]
+            TemplateImageCache().pin(self._pinned_keys)
+
+    def unpin_images(self):
+        if self._pinned_keys is not None:
+            TemplateImageCache().unpin(self._pinned_keys)
+            self._pinned_keys = None
 
     def activate(self):
         self.activated = True
+        self.pin_images()
 
     def deactivate(self):
         self.activated = False
+        self.unpin_images()  # 图片留在缓存里, 但可以被淘汰了
 
-    def match(self, full_screen_shot, dataset, state_pool, show_detail=False) -> List[Template]:
+    def valid_templates(self, state_pool: set) -> List[Template]:
+        """
+        满足前件的模板; 如果是注册过本模式的StatePool, 直接取它增量维护的结果
+        """
+        if isinstance(state_pool, StatePool):
+            eligible_templates = state_pool.eligible_templates(self)
+            if eligible_templates is not None:
+                return eligible_templates
+        return [template for template in self.templates.values() if template.check_valid(state_pool)]
+
+    def match(self, full_screen_shot, dataset, state_pool, show_detail=False,
+              fingerprint: FrameFingerprint = None) -> List[Template]:
         """
         匹配img, 满足state_set的当前状态才可以匹配，最后给回匹配成功的TemplateImage
         """
@@ -83,9 +226,9 @@ class TemplateMode:
             return []
 
         matched_templates = []
-        for template_name, template in self.templates.items():
-            if template.check_valid(state_pool) and template.detect(full_screen_shot, dataset,
-                                                                    update_dataset=True, show_detail=show_detail):
+        for template in self.valid_templates(state_pool):
+            if template.detect(full_screen_shot, dataset, update_dataset=True, show_detail=show_detail,
+                               fingerprint=fingerprint):
                 matched_templates.append(template)
 
         return matched_templates
@@ -100,6 +243,7 @@ class SwiftTemplateMode:
         templates_config = mode_config.get("templates")
         self.templates = {}
         self.screen_capturers = {}
+        from ..android.capture import ScreenCapturer  # 依赖pywin32, 只有这里需要
         for template_name, template_config in templates_config.items():
             template = Template(template_name, template_config)
             x,y,w,h = template.detector.region
@@ -133,11 +277,35 @@ class SwiftTemplateMode:
         return matched_images
 
 
+PRIORITY_GROUP = "__priority__"  # StatePool中按优先级排列全部模板的分组
+MAX_FAILURE_BACKOFF = 60.  # continue_on_failure时, 同一模板连续操作失败后最长的等待(秒)
+
+
+def _detector_signature(detector, image_hashes: Dict[str, str]) -> str:
+    """
+    检测器的内容签名: 类型 + 除模板名外的全部参数, 模板图片用内容的md5代替路径
+    :param image_hashes: 图片路径 -> md5 的缓存
+    """
+    kwargs = dict(getattr(detector, "kwargs", {}))
+    kwargs.pop("template_name", None)
+    image_path = kwargs.get("template_image")
+    if image_path is not None:
+        if image_path not in image_hashes:
+            image_hashes[image_path] = TemplateImageStore().content_hash(image_path)
+        kwargs["template_image"] = image_hashes[image_path]
+    return type(detector).__name__ + json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str)
+
+
 class TemplateModeManger:
     def __init__(self, mode_config_files: List[str],
-                 full_screen_capturer: ScreenCapturer,
-                 monitor_manager: TemplateMonitorManager = None):
-        self.state_pool = set()  # 状态集合
+                 full_screen_capturer: Capturer,
+                 monitor_manager: TemplateMonitorManager = None,
+                 short_circuit=False,
+                 frame_gating=False,
+                 detect_workers=0,
+                 load_workers=None,
+                 continue_on_failure=False):
+        self.state_pool = StatePool()  # 状态集合, 同时维护模板前件的索引
         self.matched_template_recoder = MatchedTemplateRecorder()
         self.dataset = {}  # 存放可供取用的data集合
         self.template_modes: Dict[str, TemplateMode] = {}
@@ -147,16 +315,105 @@ class TemplateModeManger:
 
         self.monitor_manager = monitor_manager
         for mode_config_file in mode_config_files:
-            template_mode = TemplateMode(mode_config_file)
+            template_mode = TemplateMode(mode_config_file, load_workers)
             self.template_modes[template_mode.mode_name] = template_mode
+
+        # 短路匹配: 所有模式的模板预先按优先级排好(同优先级保持模式、模板的原顺序)，第一个检测成功的就是结果
+        self.short_circuit = short_circuit
+        self.priority_templates: List[Tuple[TemplateMode, Template]] = sorted(
+            [(template_mode, template) for template_mode in self.template_modes.values()
+             for template in template_mode.templates.values()],
+            key=lambda item: item[1].common_info.priority
+        )
+        # 前件索引: 每个模式一组, 短路匹配的优先级顺序一组
+        for template_mode in self.template_modes.values():
+            self.state_pool.register_templates(template_mode, template_mode.templates.values())
+        self.state_pool.register_templates(PRIORITY_GROUP, [template for _, template in self.priority_templates])
+        self._template_mode_of = {template: template_mode for template_mode, template in self.priority_templates}
+        # 内容相同的检测器(同一模板图片、区域、方法、阈值...)只保留一个, 每帧只检测一次, 结果给所有用到它的模板
+        self.deduplicated_detectors = self._deduplicate_detectors()
+        # 只有激活的模式的图片常驻缓存, 启动时并行预读; 其他模式用到时才加载
+        for template_mode in self.template_modes.values():
+            if template_mode.activated:
+                template_mode.pin_images()
+                template_mode.load_images()
+        # 画面变化门控: 截图后计算指纹, 区域没变的模板沿用上次的检测结果
+        self.frame_gating = frame_gating
+        self.frame_fingerprint: Union[FrameFingerprint, None] = None
+        self._last_frame_key = None
+        self.frame_changed = True  # 本轮截图与上一轮相比是否有变化
+        # 并行检测: 各模板的detector.detect放到线程池里(matchTemplate会释放GIL), 结果按原顺序合并
+        self.detect_executor = None
+        self.detect_workers = detect_workers
+        if detect_workers > 1:
+            self.detect_executor = ThreadPoolExecutor(max_workers=detect_workers, thread_name_prefix="detect")
+        self.skipped_detections = 0  # 上一轮因短路而没有执行的检测数
+        self.total_skipped_detections = 0
+        # 操作抛出异常时: 默认计数后抛出; continue_on_failure时计数、等待后继续, 同一模板连续失败时等待加倍
+        self.continue_on_failure = continue_on_failure
+        self._failure_streaks: Dict[Template, int] = {}
+        # 运行指标: 按模板预先建好计数器, 由MetricsExporter导出
+        self.metrics = ManagerMetrics((template_mode.mode_name, template)
+                                      for template_mode, template in self.priority_templates)
         self._initialize_dataset()
 
+    @classmethod
+    def from_cfg(cls, cfg: dict, full_screen_capturer, monitor_manager: TemplateMonitorManager = None):
+        """
+        按cfg.yaml的配置创建, TemplateController和离线回放共用
+        """
+        # 模板图片缓存的上限(MB), 为空时不限制
+        if cfg.get("image_cache_mb"):
+            TemplateImageCache().configure(int(cfg.get("image_cache_mb") * 2 ** 20))
+        # 预先打包好的模式(python -m src.templates.bundle 生成), 存在时直接映射
+        if cfg.get("bundle"):
+            load_bundle(cfg.get("bundle"))
+        return cls(cfg.get("modes"), full_screen_capturer, monitor_manager,
+                   short_circuit=cfg.get("short_circuit", False),
+                   frame_gating=cfg.get("frame_gating", False),
+                   detect_workers=cfg.get("detect_workers", 0),
+                   load_workers=cfg.get("load_workers"),
+                   continue_on_failure=cfg.get("continue_on_operation_failure", False))
+
+    def _deduplicate_detectors(self):
+        """
+        :return: 被合并掉的检测器数量
+        """
+        unique_detectors = {}  # 签名 -> (第一个用到它的模板, 检测器)
+        image_hashes = {}
+        deduplicated = 0
+        for _, template in self.priority_templates:
+            if template.detector.is_stateful():  # 各模板的前件不同, 共用会混在同一份历史里
+                continue
+            signature = _detector_signature(template.detector, image_hashes)
+            owner, detector = unique_detectors.setdefault(signature, (template, template.detector))
+            if detector is not template.detector:
+                template.detector = detector
+                template.shared_detector_of = owner.template_name
+                deduplicated += 1
+        return deduplicated
+
     def _initialize_dataset(self):
         pass
 
-    def _prepare_dataset(self):
-        full_screen_img = self.screen_capturer.capture()
+    def _prepare_dataset(self, full_screen_img=None):
+        """
+        :param full_screen_img: 外部已经截好的图(如流水线的截图线程), None时自己截图
+        """
+        if full_screen_img is None:
+            start = time.perf_counter()
+            full_screen_img = self.screen_capturer.capture()
+            capture_seconds = time.perf_counter() - start
+            self.metrics.capture_histogram.observe(capture_seconds)
+            StageTimeRecorder().record(Stage.CAPTURE, type(self.screen_capturer).__name__, capture_seconds, start)
         self.dataset["full_screen_shot"] = full_screen_img
+        FrameCache().bind(full_screen_img)
+        fingerprint = FrameFingerprint(full_screen_img)
+        frame_key = fingerprint.frame_key()
+        self.frame_changed = frame_key != self._last_frame_key
+        self._last_frame_key = frame_key
+        if self.frame_gating:
+            self.frame_fingerprint = fingerprint
 
     def update_dataset(self, data):
         self.dataset.update(data)
@@ -165,20 +422,42 @@ class TemplateModeManger:
         self.state_pool.update(state_set)
 
     def no_detect(self):
+        start = time.perf_counter()
         time.sleep(1.)
+        StageTimeRecorder().record(Stage.SLEEP, "no_detect", time.perf_counter() - start, start)
+
+    def match(self, valid_template_modes: Union[Set, None] = None, show_detail=False, full_screen_img=None):
+        matched_template = self._match(valid_template_modes, show_detail, full_screen_img)
+        self.metrics.record_match(matched_template)
+        return matched_template
 
-    def match(self, valid_template_modes: Union[Set, None] = None, show_detail=False):
+    def _match(self, valid_template_modes: Union[Set, None] = None, show_detail=False, full_screen_img=None):
         ## 数据准备
-        self._prepare_dataset()
+        self._prepare_dataset(full_screen_img)
         ## 数据获取
         full_screen_shot = self.dataset["full_screen_shot"]
+        if self.short_circuit:
+            if self.detect_executor is not None:
+                self.matched_template = self._match_by_priority_parallel(full_screen_shot, valid_template_modes,
+                                                                         show_detail)
+            else:
+                self.matched_template = self._match_by_priority(full_screen_shot, valid_template_modes, show_detail)
+            return self.matched_template
         ## 匹配模板
+        if self.detect_executor is not None:
+            matched_templates_all_modes = self._match_parallel(full_screen_shot, valid_template_modes, show_detail)
+            return self._select_by_priority(matched_templates_all_modes, show_detail)
         matched_templates_all_modes = []
         for mode_name, template_mode in self.template_modes.items():
             if valid_template_modes is not None and template_mode.mode_name not in valid_template_modes:
                 continue
-            matched_templates_a_mode = template_mode.match(full_screen_shot, self.dataset, self.state_pool, show_detail=show_detail)
+            matched_templates_a_mode = template_mode.match(full_screen_shot, self.dataset, self.state_pool,
+                                                           show_detail=show_detail,
+                                                           fingerprint=self.frame_fingerprint)
             matched_templates_all_modes.extend(matched_templates_a_mode)
+        return self._select_by_priority(matched_templates_all_modes, show_detail)
+
+    def _select_by_priority(self, matched_templates_all_modes: List[Template], show_detail=False):
         if len(matched_templates_all_modes) == 0:
             self.matched_template = None
         else:
@@ -192,14 +471,136 @@ class TemplateModeManger:
             self.matched_template = matched_templates_all_modes[0]
         return self.matched_template
 
-    def execute(self, absolute_operator: Operator, interval_seconds=1.):
+    def _match_parallel(self, full_screen_shot, valid_template_modes: Union[Set, None], show_detail=False):
+        """
+        所有模式中满足前件的模板一起提交到线程池, 再按串行时的顺序(模式顺序、模板顺序)写dataset, 结果与串行一致
+        """
+        futures = []
+        for mode_name, template_mode in self.template_modes.items():
+            if not template_mode.activated:
+                continue
+            if valid_template_modes is not None and template_mode.mode_name not in valid_template_modes:
+                continue
+            for template in template_mode.valid_templates(self.state_pool):
+                futures.append((template, self.detect_executor.submit(template.evaluate, full_screen_shot,
+                                                                       show_detail, self.frame_fingerprint)))
+        matched_templates = []
+        for template, future in futures:
+            detect_exist, detect_data_dict = future.result()
+            if detect_data_dict is not None:
+                self.dataset.update(detect_data_dict)
+            if detect_exist:
+                matched_templates.append(template)
+        return matched_templates
+
+    def _match_by_priority_parallel(self, full_screen_shot, valid_template_modes: Union[Set, None],
+                                    show_detail=False):
+        """
+        短路匹配的并行版本: 按优先级提交, 同时最多detect_workers个检测在路上, 按优先级取结果, 取走一个再补提交一个;
+        找到第一个匹配后只再提交always_run的检测, 已提交的非always_run检测能取消的取消, 取消不掉的等它结束并丢弃结果,
+        dataset与串行时一致。skipped_detections只统计没有执行的检测
+        """
+        templates = []
+        for template in self.state_pool.eligible_templates(PRIORITY_GROUP):
+            template_mode = self._template_mode_of[template]
+            if not template_mode.activated:
+                continue
+            if valid_template_modes is not None and template_mode.mode_name not in valid_template_modes:
+                continue
+            templates.append(template)
+        matched_template = None
+        skipped_detections = 0
+        submitted = deque()  # (模板, future), 按优先级
+        next_index = 0
+        running = []  # 已经开始、取消不掉的检测
+        while True:
+            while len(submitted) < self.detect_workers and next_index < len(templates):
+                template = templates[next_index]
+                next_index += 1
+                if matched_template is not None and not template.common_info.always_run:
+                    skipped_detections += 1
+                    continue
+                submitted.append((template, self.detect_executor.submit(template.evaluate, full_screen_shot,
+                                                                        show_detail, self.frame_fingerprint)))
+            if not submitted:
+                break
+            template, future = submitted.popleft()
+            if matched_template is not None and not template.common_info.always_run:
+                if future.cancel():
+                    skipped_detections += 1
+                else:
+                    running.append(future)
+                continue
+            detect_exist, detect_data_dict = future.result()
+            if detect_data_dict is not None:
+                self.dataset.update(detect_data_dict)
+            if detect_exist and matched_template is None:
+                matched_template = template
+        # 等它们结束再返回, 否则会带着这一帧与下一帧的检测同时改写检测器的缓冲、跟踪状态和门控结果
+        wait(running)
+        self.skipped_detections = skipped_detections
+        self.total_skipped_detections += skipped_detections
+        if show_detail and matched_template is not None:
+            print(f"优先级: {matched_template.template_name}: {matched_template.common_info.priority}, "
+                  f"跳过检测: {skipped_detections}")
+        return matched_template
+
+    def _match_by_priority(self, full_screen_shot, valid_template_modes: Union[Set, None], show_detail=False):
+        """
+        按优先级顺序检测, 找到第一个匹配的模板后, 后面的模板只检测标记了always_run的
+        """
+        matched_template = None
+        skipped_detections = 0
+        for template in self.state_pool.eligible_templates(PRIORITY_GROUP):  # 已经满足前件, 按优先级排好
+            template_mode = self._template_mode_of[template]
+            if not template_mode.activated:
+                continue
+            if valid_template_modes is not None and template_mode.mode_name not in valid_template_modes:
+                continue
+            if matched_template is not None and not template.common_info.always_run:
+                skipped_detections += 1
+                continue
+            detect_exist = template.detect(full_screen_shot, self.dataset, update_dataset=True, show_detail=show_detail,
+                                           fingerprint=self.frame_fingerprint)
+            if detect_exist and matched_template is None:
+                matched_template = template
+        self.skipped_detections = skipped_detections
+        self.total_skipped_detections += skipped_detections
+        if show_detail and matched_template is not None:
+            print(f"优先级: {matched_template.template_name}: {matched_template.common_info.priority}, "
+                  f"跳过检测: {skipped_detections}")
+        return matched_template
+
+    def execute(self, absolute_operator: Operator, interval_seconds=1., idle_wait=True):
+        """
+        操作抛出异常时计入metrics.operation_failures, 状态池保持不变; 之后默认重新抛出,
+        continue_on_failure时打印并等待 interval_seconds × 2^(同一模板连续失败次数-1) (最多MAX_FAILURE_BACKOFF秒)后返回
+        :param idle_wait: 为True时自己控制等待(没匹配时no_detect, 操作后等interval_seconds), 为False时交给外部调度器
+        """
         if self.matched_template is None:
-            self.no_detect()
+            if idle_wait:
+                self.no_detect()
         else:
             print("执行: ", self.matched_template.template_name)
-            self.matched_template.operate(absolute_operator, self.screen_capturer, self.dataset, interval_seconds)
-            self.matched_template.update_state_pool(self.state_pool)
-            self.matched_template_recoder.update_record(self.matched_template.template_name)
+            try:
+                self.matched_template.operate(absolute_operator, self.screen_capturer, self.dataset,
+                                              interval_seconds, sleep_after_last=idle_wait)
+            except Exception:
+                self.metrics.operation_failures[self.matched_template] += 1
+                if not self.continue_on_failure:
+                    raise
+                # 不更新状态池, 等一会儿再重新匹配; 一直失败的模板不会刷屏
+                streak = self._failure_streaks.get(self.matched_template, 0) + 1
+                self._failure_streaks[self.matched_template] = streak
+                print(f"执行失败: {self.matched_template.template_name}, 连续{streak}次")
+                traceback.print_exc()
+                start = time.perf_counter()
+                time.sleep(min(interval_seconds * 2 ** (streak - 1), MAX_FAILURE_BACKOFF))
+                StageTimeRecorder().record(Stage.SLEEP, "operation_failure", time.perf_counter() - start, start)
+            else:
+                self._failure_streaks.pop(self.matched_template, None)
+                self.matched_template.update_state_pool(self.state_pool)
+                self.matched_template_recoder.update_record(self.matched_template.template_name)
         if self.monitor_manager is not None:
             self.monitor_manager.monitor(self.matched_template_recoder, self.state_pool)
 
@@ -1,44 +1,191 @@
+import cv2
 import numpy as np
 
+HIST_BITS = 5  # 直方图每个通道 2^5 = 32 个bin
+HIST_BINS = 1 << HIST_BITS
+MAX_EXACT_COLORS = 256  # 不同颜色数超过它时改用直方图, 精确计算是 U×U 的复杂度
+EXACT_CHUNK_ELEMENTS = 1 << 20  # 精确计算时每块距离矩阵的元素数, 限制内存峰值
+BG_BIN_CANDIDATES = 64  # 直方图选出背景bin后, bin内像素数最多的几个真实颜色参与精确评分
+
 
 def _compute_dist_of_colors(color1, color2):
     return np.mean(np.abs((1.0 * color1 - color2)), axis=-1)
 
 
-def binary_bg_and_words_colors(img):
-    pixels = img.reshape(-1, 3)
-    unique_colors, colors_count = np.unique(pixels, axis=0, return_counts=True)
-    # 计算每个元素与目标值的平均差值
-    diff = _compute_dist_of_colors(unique_colors[:, np.newaxis], unique_colors)
-
-    # 定义一个函数来计算不同区间的加权和
-    def weighted_sum(diff, threshold, weight):
-        masks = diff <= threshold
-        ret = []
-        for mask in masks:
-            ret.append(np.sum(colors_count[mask]))
-        return np.array(ret) * weight
+def _pack_colors(pixels):
+    # 把BGR三个通道压成一个int, 排序结果与 np.unique(axis=0) 的字典序一致
+    pixels = pixels.astype(np.int32)
+    return (pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2]
 
-    # 计算不同区间的加权和
-    # weighted_counts = weighted_sum(diff, 0, 0.7) # 这个可以优化成下面的
-    weighted_counts = colors_count * 0.7
-    weighted_counts += weighted_sum(diff, 5, 0.5)
-    weighted_counts += weighted_sum(diff, 10, 0.3)
 
-    bg_color = unique_colors[np.argmax(weighted_counts)]
-    bg_diff = _compute_dist_of_colors(unique_colors, bg_color)
+def _unpack_colors(codes):
+    return np.stack([(codes >> 16) & 0xFF, (codes >> 8) & 0xFF, codes & 0xFF], axis=-1).astype(np.uint8)
+
+
+def _choose_bg_and_words_indices(colors, weighted_counts):
+    """
+    :return: 背景色、文字色在colors中的下标
+    """
+    bg_index = np.argmax(weighted_counts)
+    bg_diff = _compute_dist_of_colors(colors, colors[bg_index])
     bg_diff_normed = bg_diff / np.max(bg_diff)
     dist_score = (bg_diff_normed ** 2) * weighted_counts
-    words_color = unique_colors[np.argmax(dist_score)]
+    return bg_index, np.argmax(dist_score)
+
+
+def _exact_weighted_counts(candidates, unique_colors, colors_count):
+    """
+    candidates中每个颜色的邻域加权和, 邻域按unique_colors(及其像素数colors_count)统计
+    """
+    # weighted_counts = weighted_sum(diff, 0, 0.7) # 这个可以优化成下面的
+    # 平均差值 <=5 / <=10 等价于通道差之和 <=15 / <=30, 用int16按行分块计算, 不物化 U×U×3 的浮点矩阵
+    candidates = candidates.astype(np.int16)
+    colors = unique_colors.astype(np.int16)
+    weighted_counts = np.zeros(len(candidates))
+    chunk = max(1, EXACT_CHUNK_ELEMENTS // len(colors))
+    for start in range(0, len(candidates), chunk):
+        diff_sum = np.abs(candidates[start: start + chunk, np.newaxis] - colors).sum(axis=-1, dtype=np.int16)
+        weighted_counts[start: start + chunk] += ((diff_sum == 0) @ colors_count) * 0.7
+        weighted_counts[start: start + chunk] += ((diff_sum <= 15) @ colors_count) * 0.5
+        weighted_counts[start: start + chunk] += ((diff_sum <= 30) @ colors_count) * 0.3
+    return weighted_counts
+
+
+def _binary_bg_and_words_colors_exact(unique_colors, colors_count):
+    # 计算不同区间的加权和
+    weighted_counts = _exact_weighted_counts(unique_colors, unique_colors, colors_count)
+    bg_index, words_index = _choose_bg_and_words_indices(unique_colors, weighted_counts)
+    return weighted_counts, unique_colors[bg_index], unique_colors[words_index]
+
+
+def _l1_ball_kernel(radius):
+    r = np.arange(-radius, radius + 1)
+    dist = np.abs(r)[:, None, None] + np.abs(r)[None, :, None] + np.abs(r)[None, None, :]
+    return (dist <= radius).astype(np.float64)
+
+
+def _convolve_hist(hist, kernel):
+    # 用FFT做3D卷积, 补零避免循环卷积把两端的颜色混在一起
+    pad = kernel.shape[0] // 2
+    shape = tuple(s + 2 * pad for s in hist.shape)
+    axes = tuple(range(hist.ndim))
+    conv = np.fft.irfftn(np.fft.rfftn(hist, shape, axes) * np.fft.rfftn(kernel, shape, axes), shape, axes)
+    conv = conv[pad: pad + hist.shape[0], pad: pad + hist.shape[1], pad: pad + hist.shape[2]]
+    return np.rint(conv)
+
 
-    # 返回结果，向上取整
+def _binary_bg_and_words_colors_hist(pixels):
+    """
+    量化到 32^3 的直方图上计算邻域加权和, 内存与颜色数无关。
+    平均差值<=5 / <=10 对应 L1 距离 <=15 / <=30, 换算成bin约为 2 / 4 个
+    先用bin内像素的均值选出背景、文字所在的bin, 再在bin附近的真实颜色中按精确的评分选出一个,
+    返回的是真实的像素颜色, 与精确计算的选择一般是一致的
+    """
+    bin_width = 256 // HIST_BINS
+    bin_index = _bin_of(pixels)
+    num_bins = HIST_BINS ** 3
+    hist = np.bincount(bin_index, minlength=num_bins).astype(np.float64)
+    color_sums = np.stack([np.bincount(bin_index, weights=pixels[:, c], minlength=num_bins) for c in range(3)],
+                          axis=-1)
+
+    hist_3d = hist.reshape(HIST_BINS, HIST_BINS, HIST_BINS)
+    weighted_counts = hist * 0.7
+    weighted_counts += _convolve_hist(hist_3d, _l1_ball_kernel(round(15 / bin_width))).reshape(-1) * 0.5
+    weighted_counts += _convolve_hist(hist_3d, _l1_ball_kernel(round(30 / bin_width))).reshape(-1) * 0.3
+
+    occupied = np.flatnonzero(hist)
+    colors = np.rint(color_sums[occupied] / hist[occupied, None]).astype(np.uint8)
+    weighted_counts = weighted_counts[occupied]
+    bg_index, words_index = _choose_bg_and_words_indices(colors, weighted_counts)
+
+    unique_codes, colors_count = np.unique(_pack_colors(pixels), return_counts=True)
+    unique_colors = _unpack_colors(unique_codes)
+    unique_quantized = (unique_colors >> (8 - HIST_BITS)).astype(np.int16)
+
+    def bin_candidates_and_counts(bin_id, reach, max_candidates=None):
+        """
+        bin_id及距离reach以内的bin中的真实颜色(最多取像素数最多的max_candidates个), 及其精确加权和;
+        通道差之和<=30的邻居每个通道都在外扩30的范围内, 只用这些颜色统计
+        """
+        bin_quantized = np.array([bin_id // HIST_BINS ** 2, bin_id // HIST_BINS % HIST_BINS, bin_id % HIST_BINS])
+        in_bins = np.flatnonzero(np.all(np.abs(unique_quantized - bin_quantized) <= reach, axis=-1))
+        in_bins = in_bins[np.argsort(-colors_count[in_bins], kind="stable")[:max_candidates]]
+        candidates = unique_colors[in_bins]
+        low, high = candidates.min(axis=0).astype(np.int16) - 30, candidates.max(axis=0).astype(np.int16) + 30
+        near = np.all((unique_colors >= low) & (unique_colors <= high), axis=-1)
+        return candidates, _exact_weighted_counts(candidates, unique_colors[near], colors_count[near])
+
+    # 背景色: bin内像素多的颜色中精确加权和最大的(背景bin里颜色多, 只取一部分)
+    bg_candidates, bg_counts = bin_candidates_and_counts(occupied[bg_index], 0, BG_BIN_CANDIDATES)
+    bg_color = bg_candidates[np.argmax(bg_counts)]
+    # 文字色: bin及相邻bin的全部颜色中 与背景色距离的平方 × 精确加权和 最大的(归一化常数对所有候选相同);
+    # 文字像素少, 精确计算的选择常常像素数不多, 也可能落在相邻bin
+    words_candidates, words_counts = bin_candidates_and_counts(occupied[words_index], 1)
+    words_color = words_candidates[np.argmax(_compute_dist_of_colors(words_candidates, bg_color) ** 2 * words_counts)]
     return weighted_counts, bg_color, words_color
 
 
-def mean_binary_img(img, bg_color=None, words_color=None):
+def _bin_of(colors):
+    quantized = (colors >> (8 - HIST_BITS)).astype(np.int32)
+    return (quantized[:, 0] * HIST_BINS + quantized[:, 1]) * HIST_BINS + quantized[:, 2]
+
+
+def binary_bg_and_words_colors(img, max_exact_colors=MAX_EXACT_COLORS):
+    """
+    :param max_exact_colors: 不同颜色数不超过它时精确计算, 否则走直方图, None表示总是精确计算
+    :return: weighted_counts, bg_color, words_color
+    """
+    pixels = img.reshape(-1, 3)
+    unique_codes, colors_count = np.unique(_pack_colors(pixels), return_counts=True)
+    if max_exact_colors is None or len(unique_codes) <= max_exact_colors:
+        return _binary_bg_and_words_colors_exact(_unpack_colors(unique_codes), colors_count)
+    return _binary_bg_and_words_colors_hist(pixels)
+
+
+def _words_diff_lut(words_color):
+    # 每个通道 v -> |v - words_color[c]|, 用uint16存放, 之后三个通道相加不会溢出
+    values = np.arange(256, dtype=np.int32)[:, np.newaxis]
+    words_color = np.asarray(words_color, dtype=np.int32)[np.newaxis, :]
+    return np.abs(values - words_color).astype(np.uint16).reshape(1, 256, 3)
+
+
+_DOUBLE_CHANNEL_SUM = np.array([[2, 2, 2]], dtype=np.float32)
+
+
+def mean_binary_img(img, bg_color=None, words_color=None, out=None):
+    """
+    像素与文字颜色的平均差 < 背景与文字颜色平均差的一半, 则为255, 否则为0。
+    等价于 2 * 通道差之和 < 背景与文字的通道差之和, 全程整数运算: LUT取差值, transform求和, compare阈值化
+    :param out: 可复用的uint8输出缓冲, 形状不对时会被重新分配
+    """
     if bg_color is None or words_color is None:
         weighted_counts, bg_color, words_color = binary_bg_and_words_colors(img)
-    words_diff = _compute_dist_of_colors(img, words_color)
-    binary_threshold = _compute_dist_of_colors(bg_color, words_color) / 2
-    binary_img = np.where(words_diff < binary_threshold, 255, 0).astype(np.uint8)
+    words_diff = cv2.LUT(img, _words_diff_lut(words_color))
+    words_diff_sum = cv2.transform(words_diff, _DOUBLE_CHANNEL_SUM)
+    bg_words_diff = np.asarray(bg_color, dtype=np.int32) - np.asarray(words_color, dtype=np.int32)
+    bg_words_diff = float(np.sum(np.abs(bg_words_diff)))
+    binary_img = cv2.compare(words_diff_sum, bg_words_diff, cv2.CMP_LT, dst=out)
     return binary_img
+
+
+if __name__ == "__main__":
+    # benchmark: 带噪声的文字截图, 不同尺寸下精确计算与直方图的耗时和颜色选择
+    import time
+
+    rng = np.random.default_rng(0)
+    for size in [32, 64, 128, 256]:
+        crop = np.full((size, size * 3, 3), (40, 60, 200), dtype=np.uint8)
+        cv2.putText(crop, "12345", (2, size - 4), cv2.FONT_HERSHEY_SIMPLEX, size / 40, (250, 250, 250), size // 16 + 1)
+        crop = np.clip(crop + rng.normal(0, 6, crop.shape), 0, 255).astype(np.uint8)
+        num_colors = len(np.unique(_pack_colors(crop.reshape(-1, 3))))
+        start = time.perf_counter()
+        _, hist_bg, hist_words = _binary_bg_and_words_colors_hist(crop.reshape(-1, 3))
+        hist_time = time.perf_counter() - start
+        exact_info = "exact 跳过(距离矩阵过大)"
+        if num_colors <= 10000:
+            start = time.perf_counter()
+            _, exact_bg, exact_words = binary_bg_and_words_colors(crop, max_exact_colors=None)
+            exact_time = time.perf_counter() - start
+            exact_info = f"exact {exact_time * 1000:.1f}ms {exact_bg.tolist()}/{exact_words.tolist()}"
+        print(f"{crop.shape[1]}x{crop.shape[0]}: 颜色数{num_colors}, {exact_info}, "
+              f"hist {hist_time * 1000:.1f}ms {hist_bg.tolist()}/{hist_words.tolist()}")
@@ -9,8 +9,12 @@ from src.utils.singleton import Singleton
 from src.utils.time import timer
 
 
+CANONICAL_SIZE = (16, 24)  # (w, h) 所有数字模板统一缩放到的尺寸
+
+
 class NumberRecognizer:
-    def __init__(self, numbers_dir):
+    def __init__(self, numbers_dir, canonical_size=CANONICAL_SIZE):
+        self.canonical_size = canonical_size
         self.numbers_templates = [[] for _ in range(10)]
         for number in os.listdir(numbers_dir):
             number_templates_dir = os.path.join(numbers_dir, number)
@@ -19,12 +23,30 @@ class NumberRecognizer:
                 number_img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
                 self.numbers_templates[int(number)].append(number_img)
 
+        # 模板缩放到同一尺寸后减均值、除模长, 堆成 N x D 的矩阵
+        # 这样与查询向量的内积就是 TM_CCOEFF_NORMED, 一次矩阵乘法就能和所有模板比较
+        template_vectors = []
+        template_numbers = []
+        for number, a_number_templates in enumerate(self.numbers_templates):
+            for number_img in a_number_templates:
+                template_vectors.append(self._normalize(number_img))
+                template_numbers.append(number)
+        self.template_matrix = np.stack(template_vectors, axis=0)
+        self.template_numbers = np.array(template_numbers)
+
+    def _normalize(self, img):
+        vec = cv2.resize(img, dsize=self.canonical_size).astype(np.float32).reshape(-1)
+        vec -= np.mean(vec)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
     def cmp(self, img1, img2):
         img2 = cv2.resize(img2, dsize=(img1.shape[1], img1.shape[0]))
         ret = cv2.matchTemplate(img2, img1, method=cv2.TM_CCOEFF_NORMED)  # img1是模板，这个img1 和 2 的顺序一定不能换
         return ret.item()
 
-    def recognize(self, img, confidence=0.5):
+    def _recognize_by_loop(self, img, confidence=0.5):
+        # 原来逐个模板resize+matchTemplate的写法, 只留给回归对照
         max_sims = [0 for _ in range(10)]
         for i, a_number_template_dir in enumerate(self.numbers_templates):
             for number_img in a_number_template_dir:
@@ -36,16 +58,43 @@ class NumberRecognizer:
         else:
             return None
 
+    def recognize_batch(self, imgs, confidence=0.5):
+        """
+        一次识别多个数字图片
+        :return: 与imgs等长的列表, 每个元素为 (数字, 相似度) 或 None
+        """
+        if len(imgs) == 0:
+            return []
+        query_matrix = np.stack([self._normalize(img) for img in imgs], axis=0)
+        sims = query_matrix @ self.template_matrix.T  # K x N
+        max_sims = np.zeros((len(imgs), 10), dtype=np.float32)  # 与原来一样, 每个数字的相似度下限为0
+        for number in range(10):
+            number_sims = sims[:, self.template_numbers == number]
+            if number_sims.shape[1] > 0:
+                max_sims[:, number] = np.maximum(np.max(number_sims, axis=1), 0)
+        best_numbers = np.argmax(max_sims, axis=1)
+        results = []
+        for i, number in enumerate(best_numbers):
+            max_sim = float(max_sims[i, number])
+            results.append((int(number), max_sim) if max_sim >= confidence else None)
+        return results
+
+    def recognize(self, img, confidence=0.5):
+        return self.recognize_batch([img], confidence)[0]
+
+
 @Singleton
 class ImageNumberSplitter:
     def __init__(self, numbers_dir="numbers"):
         self.numbers_dir = numbers_dir
         self._number_recognizer = NumberRecognizer(numbers_dir)
+        self._binary_buffer = None  # 二值化的输出缓冲, 每次识别复用
 
     def split_numbers_boxes(self, img, show=False):
         if isinstance(img, str):
             img = cv2.imread(img)
-        binary_img = mean_binary_img(img)
+        binary_img = mean_binary_img(img, out=self._binary_buffer)
+        self._binary_buffer = binary_img
         # negative_img = np.array(255 - binary_img, dtype="uint8")
         num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(binary_img, connectivity=8,
                                                                                 ltype=cv2.CV_32S)
@@ -81,11 +130,10 @@ class ImageNumberSplitter:
         ret_areas = []
         ret_xywhs = []
         ret_sims = []
-        box_imgs = [binary_img[y:y + h, x:x + w] for x, y, w, h in xywhs]
-        for i, bimg in enumerate(box_imgs):
-            if areas[i] < max_area / 5:
-                continue
-            ret = self._number_recognizer.recognize(bimg, 0.5)
+        valid_indices = [i for i in range(len(xywhs)) if areas[i] >= max_area / 5]
+        box_imgs = [binary_img[y:y + h, x:x + w] for x, y, w, h in (xywhs[i] for i in valid_indices)]
+        rets = self._number_recognizer.recognize_batch(box_imgs, 0.5)  # 所有数字一次识别
+        for i, ret in zip(valid_indices, rets):
             if ret is not None:
                 num, similarity = ret
                 numbers.append(num)
@@ -124,3 +172,24 @@ class ImageNumberSplitter:
                 cv2.imshow("img", img)
                 cv2.waitKey()
             cv2.imwrite(f"{self.numbers_dir}/{i}.png", box)
+
+
+if __name__ == "__main__":
+    # 回归: numbers目录下每个模板都应被识别为自己所在的数字, 并对比逐个匹配与批量识别的耗时
+    number_recognizer = NumberRecognizer("numbers")
+    template_imgs, template_labels = [], []
+    for label, a_number_templates in enumerate(number_recognizer.numbers_templates):
+        template_imgs.extend(a_number_templates)
+        template_labels.extend([label] * len(a_number_templates))
+
+    start = time.perf_counter()
+    loop_rets = [number_recognizer._recognize_by_loop(img) for img in template_imgs]
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    batch_rets = number_recognizer.recognize_batch(template_imgs)
+    batch_time = time.perf_counter() - start
+
+    for label, loop_ret, batch_ret in zip(template_labels, loop_rets, batch_rets):
+        assert loop_ret is not None and loop_ret[0] == label, (label, loop_ret)
+        assert batch_ret is not None and batch_ret[0] == label, (label, batch_ret)
+    print(f"{len(template_imgs)}个模板全部识别正确, loop {loop_time * 1000:.1f}ms, batch {batch_time * 1000:.1f}ms")
@@ -1,6 +1,10 @@
+import json
+import threading
 import time
 from enum import Enum
 
+import numpy as np
+
 from .singleton import Singleton
 
 def high_precision_sleep(delay_time):
@@ -78,4 +82,109 @@ class TimeRecorder:
         return self.get_record(key2) - self.get_record(key1)
 
     def _get_curr_time(self):
-        return time.perf_counter()
\ No newline at end of file
+        return time.perf_counter()
+
+class Stage(Enum):
+    CAPTURE = "capture"  # 截图
+    CROP = "crop"  # 区域裁剪与预处理(二值化、金字塔等)
+    DETECT = "detect"  # 单个模板的检测
+    OPERATE = "operate"  # 单个操作的执行, 按操作类型统计
+    SLEEP = "sleep"  # 主动等待
+    LOOP = "loop"  # 一轮完整的循环
+
+
+class TimeRing:
+    """
+    固定长度的耗时环形缓冲, 只保留最近capacity次
+    """
+
+    def __init__(self, capacity):
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.index = 0
+        self.count = 0  # 总共记录过多少次(可能超过capacity)
+        self.total = 0.  # 总耗时(包括已经被覆盖的)
+
+    def append(self, seconds):
+        self.values[self.index] = seconds
+        self.index = (self.index + 1) % len(self.values)
+        self.count += 1
+        self.total += seconds
+
+    def recent(self):
+        return self.values[:min(self.count, len(self.values))]
+
+
+@Singleton
+class StageTimeRecorder:
+    """
+    各阶段耗时统计: 每个(阶段, 名称)一个环形缓冲, 比如 (DETECT, 模板名)、(OPERATE, 操作类型)。
+    默认关闭, 关闭时record直接返回
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.capacity = 1024
+        self._rings = {}  # (Stage, name) -> TimeRing
+        self._lock = threading.Lock()
+        self.tracer = None  # 挂上ChromeTracer后, 每次record同时写一个trace span
+
+    def enable(self, capacity=1024):
+        self.enabled = True
+        if capacity != self.capacity:
+            self.capacity = capacity
+            self.reset()
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._rings = {}
+
+    def record(self, stage: Stage, name, seconds, start=None, args=None):
+        """
+        :param start: 开始时间(perf_counter), 写trace时需要
+        :param args: 附加在trace span上的信息
+        """
+        tracer = self.tracer
+        if tracer is not None and start is not None:
+            tracer.span(stage.value, str(name), start, seconds, args)
+        if not self.enabled:
+            return
+        with self._lock:
+            ring = self._rings.get((stage, name))
+            if ring is None:
+                ring = self._rings[(stage, name)] = TimeRing(self.capacity)
+            ring.append(seconds)
+
+    def summary(self, percentiles=(50, 95, 99)):
+        """
+        :return: {阶段: {名称: {"count", "total_ms", "mean_ms", "p50_ms", ...}}}, 分位数只统计最近capacity次
+        """
+        with self._lock:
+            rings = list(self._rings.items())
+        result = {}
+        for (stage, name), ring in rings:
+            recent_ms = ring.recent() * 1000
+            stats = {"count": ring.count, "total_ms": ring.total * 1000, "mean_ms": ring.total * 1000 / ring.count}
+            for p, v in zip(percentiles, np.percentile(recent_ms, percentiles)):
+                stats[f"p{p}_ms"] = float(v)
+            stats["max_ms"] = float(np.max(recent_ms))
+            result.setdefault(stage.value, {})[str(name)] = stats
+        return result
+
+    def report(self, top=10):
+        """
+        每个阶段按总耗时取前top个
+        """
+        lines = []
+        for stage, named_stats in self.summary().items():
+            lines.append(f"[{stage}]")
+            for name, stats in sorted(named_stats.items(), key=lambda item: -item[1]["total_ms"])[:top]:
+                lines.append(f"    {name}: {stats['count']}次 总{stats['total_ms']:.1f}ms "
+                             f"p50={stats['p50_ms']:.2f} p95={stats['p95_ms']:.2f} p99={stats['p99_ms']:.2f}ms")
+        return "\n".join(lines)
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf8") as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
@@ -0,0 +1,117 @@
+"""Chrome trace-event 格式的耗时记录, 生成的json可以直接拖进 Perfetto(ui.perfetto.dev) 或 chrome://tracing 查看"""
+import json
+import os
+import threading
+import time
+from queue import Queue
+
+
+class ChromeTracer:
+    """
+    span和instant事件放进队列, 由后台线程批量写文件, 记录方只做一次put
+    """
+
+    def __init__(self, path, flush_every=256):
+        """
+        :param path: 输出的trace json路径
+        :param flush_every: 后台线程每攒够多少个事件写一次文件
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.pid = os.getpid()
+        self._origin = time.perf_counter()  # trace里的时间戳都相对它, 单位微秒
+        self._events = Queue()
+        self._thread_names = {}
+        self._file = open(path, "w", encoding="utf8")
+        self._file.write("[\n")
+        self._first_event = True
+        self.closed = False
+        self._writer = threading.Thread(target=self._write_loop, name="trace-writer", daemon=True)
+        self._writer.start()
+
+    def _us(self, perf_time):
+        return (perf_time - self._origin) * 1e6
+
+    def _thread_id(self):
+        thread = threading.current_thread()
+        tid = thread.ident
+        if tid not in self._thread_names:
+            self._thread_names[tid] = thread.name
+            self._events.put({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid,
+                              "args": {"name": thread.name}})
+        return tid
+
+    def span(self, category, name, start, seconds, args=None):
+        """
+        一段完整的耗时(ph=X)
+        :param start: 开始时间(perf_counter)
+        """
+        if self.closed:
+            return
+        event = {"name": name, "cat": category, "ph": "X", "ts": self._us(start), "dur": seconds * 1e6,
+                 "pid": self.pid, "tid": self._thread_id()}
+        if args:
+            event["args"] = args
+        self._events.put(event)
+
+    def instant(self, category, name, args=None):
+        """
+        一个时刻的事件(ph=i), 比如状态池的变化
+        """
+        if self.closed:
+            return
+        event = {"name": name, "cat": category, "ph": "i", "s": "t", "ts": self._us(time.perf_counter()),
+                 "pid": self.pid, "tid": self._thread_id()}
+        if args:
+            event["args"] = args
+        self._events.put(event)
+
+    def _write_events(self, events):
+        lines = []
+        for event in events:
+            lines.append(("" if self._first_event else ",\n") + json.dumps(event, ensure_ascii=False))
+            self._first_event = False
+        self._file.write("".join(lines))
+        self._file.flush()
+
+    def _write_loop(self):
+        batch = []
+        while True:
+            event = self._events.get()
+            if event is None:
+                break
+            batch.append(event)
+            if len(batch) >= self.flush_every or self._events.empty():
+                self._write_events(batch)
+                batch = []
+        self._write_events(batch)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._events.put(None)
+        self._writer.join()
+        self._file.write("\n]\n")
+        self._file.close()
+
+
+if __name__ == "__main__":
+    # 两个线程各写几段span, 输出到 trace_demo.json
+    tracer = ChromeTracer("trace_demo.json")
+
+    def work(tag):
+        for i in range(5):
+            start = time.perf_counter()
+            time.sleep(0.01)
+            tracer.span("demo", f"{tag}-{i}", start, time.perf_counter() - start, {"i": i})
+        tracer.instant("demo", f"{tag}-done")
+
+    threads = [threading.Thread(target=work, args=(tag,), name=tag) for tag in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    tracer.close()
+    with open("trace_demo.json", "r", encoding="utf8") as f:
+        print(len(json.load(f)), "个事件")